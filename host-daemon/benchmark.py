@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк за PWM Daemon
+Стартира pwm_daemon.py срещу временно фалшиво sysfs дърво (без root права),
+натоварва го с N паралелни клиента и отчита throughput, латентност и sysfs записи.
+
+Примери:
+    python3 benchmark.py --clients 8 --duration 10 --mix duty=80,status=15,init=5
+    python3 benchmark.py --transport client --json results.json
+    python3 benchmark.py --json new.json --compare old.json
+    python3 benchmark.py --backends sysfs,mmap --transport raw
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import socket
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DAEMON = os.path.join(HERE, "pwm_daemon.py")
+# pwm_HAOS.py (PWMClient) е в корена на репото
+sys.path.insert(0, os.path.dirname(HERE))
+
+OPERATIONS = ("duty", "status", "init")
+BACKENDS = ("sysfs", "mmap")
+# Размер на фалшивия регистров блок за --backend mmap
+REGISTER_FILE_SIZE = 4096
+
+
+def parse_mix(value):
+    """Парсни "duty=80,status=15,init=5" в {операция: тегло}"""
+    mix = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Непозната операция: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def make_fake_sysfs(root, npwm=4):
+    """Създай фалшиво PWM sysfs дърво с вече експортирани канали"""
+    chip = os.path.join(root, "pwmchip0")
+    os.makedirs(chip)
+    for name, value in (("npwm", str(npwm)), ("export", ""), ("unexport", "")):
+        with open(os.path.join(chip, name), "w") as f:
+            f.write(value)
+    for channel in range(npwm):
+        path = os.path.join(chip, f"pwm{channel}")
+        os.makedirs(path)
+        for attr in ("period", "duty_cycle", "enable"):
+            with open(os.path.join(path, attr), "w") as f:
+                f.write("0")
+
+
+def make_register_file(path):
+    """Нулиран файл, който замества регистровия блок на PWM контролера"""
+    with open(path, "wb") as f:
+        f.write(bytes(REGISTER_FILE_SIZE))
+
+
+def backend_args(backend, root):
+    """Аргументи на daemon за backend-а; root е временната директория"""
+    if backend == "mmap":
+        path = os.path.join(root, "pwm-registers")
+        make_register_file(path)
+        return ["--backend", "mmap", "--mmap-path", path, "--mmap-offset", "0"]
+    sysfs_root = os.path.join(root, "sysfs")
+    make_fake_sysfs(sysfs_root)
+    return ["--sysfs-root", sysfs_root]
+
+
+def free_port():
+    """Свободен TCP порт"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_daemon(port, extra_args):
+    """Стартирай daemon и изчакай да отговаря (backend-ът е в extra_args)"""
+    cmd = [sys.executable, DAEMON, "--host", "127.0.0.1", "--port", str(port),
+           "--unix-socket", "", "--state-journal", "",
+           # Бенчмаркът мери daemon-а, не лимитите; --daemon-args може да ги включи
+           "--client-rate", "0", "--client-connections", "0", "--control-reserve", "0"] + extra_args
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/status")
+            conn.getresponse().read()
+            conn.close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"Daemon не стартира: {' '.join(cmd)}")
+
+
+def write_stats(port):
+    """Общ брой и общо време (s) на записите в PWM канали от /metrics"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", "/metrics")
+    body = conn.getresponse().read().decode()
+    conn.close()
+    count = total = 0
+    for line in body.splitlines():
+        if line.startswith("pwm_sysfs_write_duration_seconds_count"):
+            count += int(line.rsplit(" ", 1)[1])
+        elif line.startswith("pwm_sysfs_write_duration_seconds_sum"):
+            total += float(line.rsplit(" ", 1)[1])
+    return count, total
+
+
+class RawHTTPWorker:
+    """Клиент с една keep-alive връзка и ръчно сериализиран JSON"""
+
+    def __init__(self, port, gpio_pin, frequency):
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        self.gpio_pin = gpio_pin
+        self.frequency = frequency
+
+    def _post(self, path, data):
+        self.conn.request("POST", path, body=json.dumps(data),
+                          headers={"Content-Type": "application/json"})
+        response = self.conn.getresponse()
+        response.read()
+        return response.status == 200
+
+    def duty(self, value):
+        return self._post("/duty", {"gpio_pin": self.gpio_pin, "duty_cycle": value})
+
+    def init(self):
+        return self._post("/init", {"gpio_pin": self.gpio_pin, "frequency": self.frequency})
+
+    def status(self):
+        self.conn.request("GET", f"/status/{self.gpio_pin}")
+        response = self.conn.getresponse()
+        response.read()
+        return response.status == 200
+
+    def close(self):
+        self.conn.close()
+
+
+class PWMClientWorker:
+    """Клиент през PWMClient от addon-а"""
+
+    def __init__(self, port, gpio_pin, frequency):
+        from pwm_HAOS import PWMClient, logger
+        # INFO лог за всяка заявка изкривява измерването
+        logger.setLevel(logging.WARNING)
+        self.client = PWMClient(host="127.0.0.1", port=port)
+        self.gpio_pin = gpio_pin
+        self.frequency = frequency
+        self.client.initialize_pwm(gpio_pin, frequency)
+
+    def duty(self, value):
+        return self.client.set_duty_cycle(value)
+
+    def init(self):
+        return self.client.initialize_pwm(self.gpio_pin, self.frequency)
+
+    def status(self):
+        return bool(self.client.get_status())
+
+    def close(self):
+        self.client.close()
+
+
+WORKERS = {"raw": RawHTTPWorker, "client": PWMClientWorker}
+
+
+def percentile(sorted_values, fraction):
+    """Перцентил от сортиран списък"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_load(port, backend, transport, args):
+    """Пусни args.clients нишки за args.duration секунди; връща резултата"""
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(args.clients + 1)
+    stop = threading.Event()
+
+    def client_loop(index):
+        gpio_pin = args.pins[index % len(args.pins)]
+        worker = WORKERS[transport](port, gpio_pin, args.frequency)
+        rng = random.Random(args.seed + index)
+        local = {name: [] for name in names}
+        local_errors = {name: 0 for name in names}
+        start_barrier.wait()
+        try:
+            while not stop.is_set():
+                name = rng.choices(names, weights)[0]
+                start = time.perf_counter()
+                if name == "duty":
+                    ok = worker.duty(rng.randint(0, 100))
+                elif name == "status":
+                    ok = worker.status()
+                else:
+                    ok = worker.init()
+                local[name].append(time.perf_counter() - start)
+                if not ok:
+                    local_errors[name] += 1
+        finally:
+            worker.close()
+            with lock:
+                for name in names:
+                    latencies[name] += local[name]
+                    errors[name] += local_errors[name]
+
+    threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    writes_before, write_time_before = write_stats(port)
+    start_barrier.wait()
+    started = time.perf_counter()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    writes, write_time = write_stats(port)
+    writes -= writes_before
+    write_time -= write_time_before
+
+    result = {"backend": backend, "transport": transport, "elapsed_s": round(elapsed, 3), "operations": {}}
+    total = 0
+    for name in names:
+        values = sorted(latencies[name])
+        total += len(values)
+        result["operations"][name] = {
+            "count": len(values),
+            "errors": errors[name],
+            "throughput_rps": round(len(values) / elapsed, 1),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        }
+    result["throughput_rps"] = round(total / elapsed, 1)
+    result["sysfs_writes_per_s"] = round(writes / elapsed, 1)
+    result["write_cost_us"] = round(write_time / writes * 1e6, 2) if writes else 0.0
+    return result
+
+
+def git_revision():
+    """Текущият commit (ако има git)"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result):
+    """Таблица с резултатите за един transport"""
+    print(f"\n[{result['backend']}/{result['transport']}] {result['throughput_rps']} req/s, "
+          f"{result['sysfs_writes_per_s']} writes/s, {result['write_cost_us']} us/write")
+    print(f"  {'op':<8}{'count':>9}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, op in result["operations"].items():
+        print(f"  {name:<8}{op['count']:>9}{op['errors']:>8}{op['throughput_rps']:>10}"
+              f"{op['p50_ms']:>10}{op['p95_ms']:>10}{op['p99_ms']:>10}")
+
+
+def print_comparison(current, baseline):
+    """Разлика спрямо предишен резултат (--compare)"""
+    print(f"\nСравнение с {baseline.get('revision') or 'baseline'}:")
+    previous = {(r.get("backend", "sysfs"), r["transport"]): r for r in baseline.get("results", [])}
+    for result in current["results"]:
+        old = previous.get((result["backend"], result["transport"]))
+        if not old:
+            continue
+
+        def delta(new, before):
+            return f"{(new - before) / before * 100:+.1f}%" if before else "n/a"
+
+        print(f"  [{result['backend']}/{result['transport']}] throughput "
+              f"{delta(result['throughput_rps'], old['throughput_rps'])}")
+        for name, op in result["operations"].items():
+            before = old["operations"].get(name)
+            if before:
+                print(f"    {name:<8} p50 {delta(op['p50_ms'], before['p50_ms']):>8}  "
+                      f"p99 {delta(op['p99_ms'], before['p99_ms']):>8}")
+
+
+def parse_args():
+    """Аргументи от командния ред"""
+    parser = argparse.ArgumentParser(description="Бенчмарк за PWM Daemon")
+    parser.add_argument("--clients", type=int, default=4, help="Брой паралелни клиенти")
+    parser.add_argument("--duration", type=float, default=5, help="Продължителност (s) за всеки transport")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("duty=80,status=15,init=5"),
+                        help="Тегла на операциите, напр. duty=80,status=15,init=5")
+    parser.add_argument("--transport", choices=["raw", "client", "both"], default="both",
+                        help="raw: http.client; client: PWMClient от addon-а")
+    parser.add_argument("--backends", type=lambda v: [b for b in v.split(",") if b], default=["sysfs"],
+                        help=f"PWM backend-и на daemon за сравнение: {','.join(BACKENDS)}")
+    parser.add_argument("--pins", type=lambda v: [int(p) for p in v.split(",")], default=[12, 13],
+                        help="GPIO пинове, разпределени между клиентите")
+    parser.add_argument("--frequency", type=int, default=26000, help="Честота за /init")
+    parser.add_argument("--seed", type=int, default=1, help="Seed за избора на операции")
+    parser.add_argument("--daemon-args", default="",
+                        help='Допълнителни аргументи за daemon, напр. "--workers 16 --max-duty-rate 50"')
+    parser.add_argument("--json", help="Запиши резултата като JSON в този файл")
+    parser.add_argument("--compare", help="JSON от предишно пускане за сравнение")
+    return parser.parse_args()
+
+
+def main():
+    """Main entry point"""
+    args = parse_args()
+    transports = ["raw", "client"] if args.transport == "both" else [args.transport]
+    for backend in args.backends:
+        if backend not in BACKENDS:
+            sys.exit(f"Непознат backend: {backend}")
+
+    results = []
+    for backend in args.backends:
+        root = tempfile.mkdtemp(prefix="pwm-bench-")
+        port = free_port()
+        proc = None
+        try:
+            proc = start_daemon(port, backend_args(backend, root) + args.daemon_args.split())
+
+            # Инициализирай пиновете преди измерването; връзките се затварят,
+            # за да не остава неактивна keep-alive връзка по време на измерването
+            for gpio_pin in args.pins:
+                setup = RawHTTPWorker(port, gpio_pin, args.frequency)
+                try:
+                    setup.init()
+                finally:
+                    setup.close()
+
+            for transport in transports:
+                result = run_load(port, backend, transport, args)
+                print_result(result)
+                results.append(result)
+        finally:
+            if proc:
+                proc.terminate()
+                proc.wait()
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": {
+            "clients": args.clients,
+            "duration_s": args.duration,
+            "mix": args.mix,
+            "pins": args.pins,
+            "backends": args.backends,
+            "daemon_args": args.daemon_args,
+        },
+        "results": results,
+    }
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"\nРезултат: {args.json}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(output, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,29 @@ import os
 import sys
 import json
 import logging
+import logging.handlers
+import queue
+import argparse
+import base64
+import mmap
+import hashlib
+import ipaddress
+import signal
+import select
+import selectors
+import socket
+import socketserver
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 import threading
+import time
+import bisect
+import math
+import contextlib
+import re
+from collections import OrderedDict, deque
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,21 +37,430 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Нива, които могат да се зададат с --log-level и POST /loglevel
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+# Интервал (s) на обобщените редове за често повтарящи се събития (duty cycle)
+LOG_SUMMARY_INTERVAL = 10
 
-class PWMController:
-    """Hardware PWM контролер чрез sysfs"""
+PWM_SYSFS_ROOT = "/sys/class/pwm"
+
+# GPIO -> PWM channel по подразбиране (0 за GPIO12/18, 1 за GPIO13/19;
+# непознатите пинове също получават канал 1, както досега)
+DEFAULT_PIN_CHANNELS = {12: 0, 13: 1, 18: 0, 19: 1}
+DEFAULT_PIN_CHANNEL = 1
+# Честота (Hz) при /init без frequency на неинициализиран пин
+DEFAULT_FREQUENCY = 26000
+# Изчакване на sysfs атрибутите след export: начална стъпка и таван (s)
+EXPORT_POLL_INITIAL = 0.001
+EXPORT_POLL_MAX = 0.05
+
+# Регистров блок на PWM контролера (RP1 PWM0 на Raspberry Pi 5) за --backend mmap:
+# физически адрес, тактова честота и брой канали по подразбиране
+MMAP_DEFAULT_PATH = "/dev/mem"
+MMAP_DEFAULT_OFFSET = 0x1f00098000
+MMAP_DEFAULT_CLOCK_HZ = 50_000_000
+MMAP_DEFAULT_CHANNELS = 4
+# Отмествания на регистрите (байтове); каналните се повтарят през MMAP_CHANNEL_STRIDE
+MMAP_GLOBAL_CTRL = 0x00       # битове 0..N-1: enable на каналите, бит 31: прилагане на новите стойности
+MMAP_GLOBAL_UPDATE = 1 << 31
+MMAP_CHANNEL_BASE = 0x14
+MMAP_CHANNEL_STRIDE = 0x10
+MMAP_CHAN_CTRL = 0x0          # битове 0..2: режим (1 = trailing edge)
+MMAP_CHAN_RANGE = 0x4         # период в тактове
+MMAP_CHAN_DUTY = 0xc          # duty в тактове
+MMAP_MODE_TRAILING_EDGE = 1
+
+# Граници на латентност в секунди за хистограмите в /metrics
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Endpoints с предварително създадени броячи; всичко останало е "other"
+METRIC_ENDPOINTS = ("/init", "/duty", "/enable", "/disable", "/unexport", "/fade",
+                    "/batch", "/pins/{pin}", "/rescan", "/status", "/status/{pin}", "/topology",
+                    "/events", "/stream", "/metrics", "/loglevel", "other")
+
+# Admission control: управляващите операции имат приоритет пред четенията
+CONTROL_ENDPOINTS = ("/init", "/duty", "/enable", "/disable", "/unexport", "/fade", "/batch", "/pins/{pin}")
+# Дълготрайни връзки - минават през rate limit-а, но не заемат място за заявка
+STREAMING_ENDPOINTS = ("/stream", "/events")
+ADMISSION_CLIENT_RATE = 200
+ADMISSION_CLIENT_BURST = 400
+ADMISSION_CLIENT_CONNECTIONS = 16  # пул на добавката + /events и probe, с резерв
+ADMISSION_CONTROL_RESERVE = 2
+ADMISSION_MAX_CLIENTS = 1024    # най-много token buckets по адрес (LRU)
+REJECT_REASONS = ("client_rate", "endpoint_rate", "saturated", "connections", "streams")
+REJECT_RESPONSE = (b"HTTP/1.1 429 Too Many Requests\r\nRetry-After: 1\r\n"
+                   b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+
+# Колко изчаква работната нишка следваща заявка по keep-alive връзка, преди да я паркира
+KEEPALIVE_GRACE = 0.02
+
+# Най-много кеширани варианта (пин, fields) на тялото на /status за една версия
+STATUS_CACHE_SIZE = 64
+
+# Операции, допустими в POST /batch
+BATCH_OPERATIONS = ("init", "duty", "enable", "disable")
+
+# Бинарен протокол по Unix socket: заявка и отговор са по един фиксиран frame
+# <opcode:u8> <pin:u8> <status:u16> <value:f32> <seq:u32>
+# В заявката status е 0; в отговора opcode, pin и seq са копирани от заявката.
+BINARY_FRAME = struct.Struct("<BBHfI")
+OP_PING = 0
+OP_INIT = 1  # value = frequency (Hz), 0 = текущата/по подразбиране
+OP_DUTY = 2  # value = duty cycle (%)
+OP_ENABLE = 3
+OP_DISABLE = 4
+OP_STATUS = 5  # отговор: value = duty cycle (%)
+STATUS_OK = 0
+STATUS_FAILED = 1
+STATUS_BAD_REQUEST = 2
+
+# WebSocket поток за setpoints (GET /stream): всяко binary съобщение съдържа
+# един или повече записа <seq:u32> <pin:u8> <duty:f32>
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_OP_TEXT = 0x1
+WS_OP_BINARY = 0x2
+WS_OP_CLOSE = 0x8
+WS_OP_PING = 0x9
+WS_OP_PONG = 0xA
+STREAM_SETPOINT = struct.Struct("<IBf")
+STREAM_MAX_PAYLOAD = 64 * 1024
+
+# Server-sent events (GET /events): полета, чиято промяна генерира събитие,
+# брой пазени събития за възобновяване и интервал на keep-alive коментарите
+EVENT_FIELDS = ("duty_cycle", "enabled", "frequency")
+EVENT_HISTORY = 256
+EVENT_KEEPALIVE = 15
+
+# Резолюция на duty-to-ns таблиците: стъпки на 1% (10 -> 0.1%)
+DUTY_LUT_SCALE = 10
+# Долна граница за експоненциалния преход (log(0) не е дефиниран)
+FADE_EXP_FLOOR = 0.1
+FADE_GAMMA = 2.2
+
+
+def start_async_logging():
+    """Премести handler-ите на root logger-а зад опашка
+    
+    Нишките само слагат записа в опашката; форматирането и писането в
+    stderr/journald стават във фонова нишка на QueueListener.
+    Връща listener-а (спира се с .stop() при изход).
+    """
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+
+def build_duty_lut(period_ns):
+    """Таблица duty cycle (в стъпки от 1/DUTY_LUT_SCALE %) -> наносекунди"""
+    steps = 100 * DUTY_LUT_SCALE
+    return [period_ns * i // steps for i in range(steps + 1)]
+
+
+def ease_linear(start, target, progress):
+    """Линеен преход"""
+    return start + (target - start) * progress
+
+
+def ease_exponential(start, target, progress):
+    """Експоненциален преход (равни отношения за равни интервали от време)"""
+    start = max(start, FADE_EXP_FLOOR)
+    target = max(target, FADE_EXP_FLOOR)
+    return start * (target / start) ** progress
+
+
+def ease_gamma(start, target, progress):
+    """Перцептивно линеен преход (интерполация в gamma пространство)"""
+    start = (start / 100) ** (1 / FADE_GAMMA)
+    target = (target / 100) ** (1 / FADE_GAMMA)
+    return 100 * (start + (target - start) * progress) ** FADE_GAMMA
+
+
+FADE_CURVES = {
+    "linear": ease_linear,
+    "exponential": ease_exponential,
+    "gamma": ease_gamma,
+}
+
+
+class Histogram:
+    """Prometheus хистограма с фиксирани граници (LATENCY_BUCKETS)"""
+    
+    __slots__ = ("counts", "total", "lock")
     
     def __init__(self):
-        self.pwm_instances = {}  # {gpio_pin: PWMInstance}
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
         self.lock = threading.Lock()
     
-    def _find_pwm_chip(self):
-        """Намери наличен PWM chip"""
-        for chip in ["pwmchip0", "pwmchip2", "pwmchip3"]:
-            path = f"/sys/class/pwm/{chip}"
-            if os.path.exists(path):
-                return chip
-        return None
+    def observe(self, value):
+        """Добави едно измерване (в секунди)"""
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += value
+    
+    def render(self, name, labels, lines):
+        """Добави редовете на хистограмата в Prometheus text формат"""
+        with self.lock:
+            counts = list(self.counts)
+            total = self.total
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {total}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+
+
+class ChannelMetrics:
+    """Латентност и грешки на sysfs записите за един PWM канал"""
+    
+    __slots__ = ("write_latency", "write_errors")
+    
+    def __init__(self):
+        self.write_latency = Histogram()
+        self.write_errors = 0
+
+
+class PWMMetrics:
+    """Броячи за GET /metrics
+    
+    Всички броячи и хистограми се създават предварително (за endpoints при
+    старт, за каналите при първото им отваряне), така че записите по
+    горещия път само увеличават съществуващи стойности.
+    """
+    
+    def __init__(self):
+        self.request_latency = {endpoint: Histogram() for endpoint in METRIC_ENDPOINTS}
+        self.request_errors = dict.fromkeys(METRIC_ENDPOINTS, 0)
+        self.lock_wait = Histogram()
+        self.channels = {}  # {(chip, channel): ChannelMetrics}
+    
+    def channel(self, pwm_chip, channel):
+        """Броячите на канала (създават се при първо използване)"""
+        return self.channels.setdefault((pwm_chip, channel), ChannelMetrics())
+    
+    def observe_request(self, endpoint, elapsed, status_code):
+        """Отчети една HTTP заявка"""
+        if endpoint not in self.request_errors:
+            endpoint = "other"
+        self.request_latency[endpoint].observe(elapsed)
+        if status_code >= 400:
+            self.request_errors[endpoint] += 1
+    
+    def render(self, controller, active_connections, admission=None):
+        """Всички метрики в Prometheus text формат"""
+        lines = ["# HELP pwm_http_request_duration_seconds HTTP request latency by endpoint",
+                 "# TYPE pwm_http_request_duration_seconds histogram"]
+        for endpoint, histogram in self.request_latency.items():
+            histogram.render("pwm_http_request_duration_seconds", f'endpoint="{endpoint}"', lines)
+        
+        lines += ["# HELP pwm_http_request_errors_total HTTP responses with status >= 400",
+                  "# TYPE pwm_http_request_errors_total counter"]
+        for endpoint, count in self.request_errors.items():
+            lines.append(f'pwm_http_request_errors_total{{endpoint="{endpoint}"}} {count}')
+        
+        lines += ["# HELP pwm_http_active_connections Open HTTP connections",
+                  "# TYPE pwm_http_active_connections gauge",
+                  f"pwm_http_active_connections {active_connections}"]
+        if admission is not None:
+            admission.render(lines)
+        
+        lines += ["# HELP pwm_lock_wait_seconds Time spent waiting for channel locks",
+                  "# TYPE pwm_lock_wait_seconds histogram"]
+        self.lock_wait.render("pwm_lock_wait_seconds", 'lock="channel"', lines)
+        
+        lines += ["# HELP pwm_sysfs_write_duration_seconds sysfs attribute write latency",
+                  "# TYPE pwm_sysfs_write_duration_seconds histogram"]
+        for (pwm_chip, channel), metrics in list(self.channels.items()):
+            metrics.write_latency.render("pwm_sysfs_write_duration_seconds",
+                                         f'chip="{pwm_chip}",channel="{channel}"', lines)
+        lines += ["# HELP pwm_sysfs_write_errors_total Failed sysfs attribute writes",
+                  "# TYPE pwm_sysfs_write_errors_total counter"]
+        for (pwm_chip, channel), metrics in list(self.channels.items()):
+            lines.append(f'pwm_sysfs_write_errors_total{{chip="{pwm_chip}",channel="{channel}"}} '
+                         f'{metrics.write_errors}')
+        
+        gauges = (
+            ("pwm_duty_cycle_percent", "gauge", "Current duty cycle", "duty_cycle"),
+            ("pwm_enabled", "gauge", "1 if the PWM output is enabled", "enabled"),
+            ("pwm_frequency_hertz", "gauge", "PWM frequency", "frequency"),
+            ("pwm_duty_writes_total", "counter", "Duty cycle writes to sysfs", "duty_writes"),
+            ("pwm_duty_skipped_total", "counter", "Duty cycle writes skipped (unchanged)", "duty_skipped"),
+            ("pwm_duty_coalesced_total", "counter", "Duty cycle updates replaced before write", "duty_coalesced"),
+        )
+        snapshot = controller.get_status()
+        for name, kind, help_text, field in gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for gpio_pin, status in snapshot.items():
+                lines.append(f'{name}{{gpio="{gpio_pin}"}} {int(status[field]) if field == "enabled" else status[field]}')
+        return "\n".join(lines) + "\n"
+
+
+class TimedLock:
+    """RLock, който отчита времето за изчакване в хистограма"""
+    
+    __slots__ = ("lock", "wait")
+    
+    def __init__(self, wait_histogram):
+        self.lock = threading.RLock()
+        self.wait = wait_histogram
+    
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.wait.observe(time.perf_counter() - start)
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+class PWMChannel:
+    """Кеширани файлови дескриптори към sysfs атрибутите на един PWM канал
+    
+    Атрибутите се отварят веднъж и се пишат с pwrite() от позиция 0, вместо
+    open/write/close при всяка промяна. При грешка дескрипторите се затварят
+    и се отварят наново при следващия запис.
+    """
+    
+    ATTRIBUTES = ("period", "duty_cycle", "enable")
+    
+    def __init__(self, pwm_path, truncate=False, metrics=None):
+        self.pwm_path = pwm_path
+        # Обикновени файлове (фалшив sysfs) трябва да се отрязват след запис
+        self.truncate = truncate
+        self.metrics = metrics or ChannelMetrics()
+        self.fds = {}
+    
+    def open(self):
+        """Отвори всички атрибути на канала"""
+        for attr in self.ATTRIBUTES:
+            if attr not in self.fds:
+                self.fds[attr] = os.open(f"{self.pwm_path}/{attr}", os.O_RDWR)
+    
+    def close(self):
+        """Затвори всички отворени дескриптори"""
+        fds, self.fds = self.fds, {}
+        for fd in fds.values():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+    
+    def write(self, attr, value):
+        """Запиши цяло число в атрибут; при грешка отвори наново и опитай още веднъж"""
+        data = b"%d" % value
+        for attempt in range(2):
+            start = time.perf_counter()
+            try:
+                fd = self.fds.get(attr)
+                if fd is None:
+                    self.open()
+                    fd = self.fds[attr]
+                os.pwrite(fd, data, 0)
+                if self.truncate:
+                    os.ftruncate(fd, len(data))
+                self.metrics.write_latency.observe(time.perf_counter() - start)
+                return True
+            except OSError as e:
+                self.metrics.write_errors += 1
+                self.close()
+                if attempt:
+                    logger.error(f"Error writing to {self.pwm_path}/{attr}: {e}")
+        return False
+    
+    def read_state(self):
+        """Прочети текущите period, duty_cycle и enable от sysfs като цели числа"""
+        self.open()
+        state = {}
+        for attr in self.ATTRIBUTES:
+            value = os.pread(self.fds[attr], 32, 0).strip()
+            state[attr] = int(value) if value else 0
+        return state
+    
+    def apply(self, live, period_ns, duty_ns, enabled):
+        """Запиши само атрибутите, които се различават от live, в допустим ред
+        
+        Ядрото изисква duty_cycle <= period след всеки запис, затова при
+        намаляване на периода под текущия duty първо се записва duty_cycle.
+        Изключването е първо, включването - последно.
+        Връща списък от извършените записи [(attr, value)] или None при грешка.
+        """
+        writes = []
+        steps = []
+        if live["enable"] and not enabled:
+            steps.append(("enable", 0))
+        period_step = [("period", period_ns)] if live["period"] != period_ns else []
+        duty_step = [("duty_cycle", duty_ns)] if live["duty_cycle"] != duty_ns else []
+        if period_step and live["duty_cycle"] > period_ns:
+            steps += duty_step + period_step
+        else:
+            steps += period_step + duty_step
+        if enabled and not live["enable"]:
+            steps.append(("enable", 1))
+        
+        for attr, value in steps:
+            if not self.write(attr, value):
+                return None
+            writes.append((attr, value))
+        return writes
+
+
+class SysfsBackend:
+    """PWM през sysfs (/sys/class/pwm) - backend по подразбиране
+    
+    Backend-ът дава на PWMController чиповете (scan_chips), отваря канал
+    (open_channel -> обект с write/read_state/apply/close и pwm_path) и го
+    освобождава (release_channel).
+    """
+    
+    name = "sysfs"
+    
+    def __init__(self, sysfs_root=PWM_SYSFS_ROOT, export_timeout=1.0):
+        self.sysfs_root = sysfs_root
+        # Максимално време за поява на атрибутите след export
+        self.export_timeout = export_timeout
+        # Извън /sys (напр. тестово дърво) файловете са обикновени
+        real_root = os.path.realpath(sysfs_root)
+        self.truncate_writes = not real_root.startswith("/sys/")
+    
+    def scan_chips(self):
+        """Наличните PWM чипове и броя им канали {chip: npwm}"""
+        chips = {}
+        try:
+            names = os.listdir(self.sysfs_root)
+        except OSError as e:
+            logger.error(f"PWM sysfs {self.sysfs_root} не е достъпен: {e}")
+            names = []
+        for name in names:
+            match = re.fullmatch(r"pwmchip(\d+)", name)
+            if not match:
+                continue
+            try:
+                with open(f"{self.sysfs_root}/{name}/npwm") as f:
+                    chips[name] = int(f.read().strip())
+            except (OSError, ValueError) as e:
+                logger.warning(f"Пропускам {name}: {e}")
+        return dict(sorted(chips.items(), key=lambda item: int(item[0][7:])))
+    
+    def _wait_for_export(self, pwm_path):
+        """Изчакай атрибутите на експортирания канал с нарастваща стъпка до export_timeout"""
+        deadline = time.monotonic() + self.export_timeout
+        delay = EXPORT_POLL_INITIAL
+        while True:
+            if all(os.access(f"{pwm_path}/{attr}", os.W_OK) for attr in PWMChannel.ATTRIBUTES):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, EXPORT_POLL_MAX)
     
     def _write_file(self, path, value):
         """Запиши стойност във файл"""
@@ -43,88 +472,825 @@ class PWMController:
             logger.error(f"Error writing to {path}: {e}")
             return False
     
-    def _read_file(self, path):
-        """Прочети стойност от файл"""
+    def open_channel(self, pwm_chip, channel, metrics=None):
+        """Export (ако е нужно) и отвори атрибутите на канала; None при грешка"""
+        pwm_path = f"{self.sysfs_root}/{pwm_chip}/pwm{channel}"
+        
+        # Export ако не е експортиран
+        if not os.path.exists(pwm_path):
+            export_path = f"{self.sysfs_root}/{pwm_chip}/export"
+            self._write_file(export_path, str(channel))
+        
+        if not self._wait_for_export(pwm_path):
+            logger.error(f"PWM path {pwm_path} не е готов след {self.export_timeout}s")
+            return None
+        
+        handle = PWMChannel(pwm_path, truncate=self.truncate_writes, metrics=metrics)
         try:
-            with open(path, 'r') as f:
-                return f.read().strip()
-        except Exception as e:
+            handle.open()
+        except OSError as e:
+            logger.error(f"Не може да се отвори {pwm_path}: {e}")
+            return None
+        return handle
+    
+    def release_channel(self, pwm_chip, channel, handle):
+        """Изключи, затвори и unexport-ни канала"""
+        handle.write("enable", 0)
+        handle.close()
+        self._write_file(f"{self.sysfs_root}/{pwm_chip}/unexport", str(channel))
+    
+    def close(self):
+        """Нищо за освобождаване"""
+
+
+class RegisterChannel:
+    """Един канал на MmapBackend: period/duty/enable като регистри в тактове
+    
+    Стойностите в ns се преобразуват в тактове на clock_hz. read_state връща
+    последно записаните ns, ако регистърът не е променен отвън, така че
+    повторен /init със същия период не пише нищо.
+    """
+    
+    def __init__(self, backend, pwm_chip, channel, metrics=None):
+        self.backend = backend
+        self.channel = channel
+        self.pwm_path = f"{backend.path}@{backend.offset:#x}/{pwm_chip}/pwm{channel}"
+        self.metrics = metrics or ChannelMetrics()
+        base = MMAP_CHANNEL_BASE + channel * MMAP_CHANNEL_STRIDE
+        self.registers = {"period": (base + MMAP_CHAN_RANGE) // 4, "duty_cycle": (base + MMAP_CHAN_DUTY) // 4}
+        self.ctrl = (base + MMAP_CHAN_CTRL) // 4
+        self.shadow = {}  # {attr: (тактове, ns)} на последния запис
+    
+    def open(self):
+        """Регистрите са достъпни, докато backend-ът е отворен"""
+    
+    def close(self):
+        """Нищо за затваряне (регистровият блок е общ за каналите)"""
+    
+    def _to_ticks(self, ns):
+        return ns * self.backend.clock_hz // 1_000_000_000
+    
+    def write(self, attr, value):
+        """Запиши period/duty_cycle (ns) или enable (0/1) в регистрите"""
+        start = time.perf_counter()
+        regs = self.backend.regs
+        try:
+            with self.backend.lock:
+                if attr == "enable":
+                    regs[self.ctrl] = (regs[self.ctrl] & ~0x7) | MMAP_MODE_TRAILING_EDGE
+                    bit = 1 << self.channel
+                    ctrl = regs[MMAP_GLOBAL_CTRL // 4]
+                    ctrl = (ctrl | bit) if value else (ctrl & ~bit)
+                else:
+                    ticks = self._to_ticks(value)
+                    regs[self.registers[attr]] = ticks
+                    self.shadow[attr] = (ticks, value)
+                    ctrl = regs[MMAP_GLOBAL_CTRL // 4]
+                regs[MMAP_GLOBAL_CTRL // 4] = (ctrl | MMAP_GLOBAL_UPDATE) & 0xFFFFFFFF
+        except (ValueError, IndexError, TypeError) as e:
+            self.metrics.write_errors += 1
+            logger.error(f"Error writing {attr} to {self.pwm_path}: {e}")
+            return False
+        self.metrics.write_latency.observe(time.perf_counter() - start)
+        return True
+    
+    def read_state(self):
+        """Прочети period, duty_cycle (ns) и enable от регистрите"""
+        regs = self.backend.regs
+        state = {}
+        for attr, index in self.registers.items():
+            ticks = regs[index]
+            shadow = self.shadow.get(attr)
+            state[attr] = shadow[1] if shadow and shadow[0] == ticks else ticks * 1_000_000_000 // self.backend.clock_hz
+        state["enable"] = (regs[MMAP_GLOBAL_CTRL // 4] >> self.channel) & 1
+        return state
+    
+    # Същият ред на записите като при sysfs
+    apply = PWMChannel.apply
+
+
+class MmapBackend:
+    """PWM чрез директен запис в регистрите на контролера през mmap
+    
+    path/offset сочат регистровия блок (по подразбиране RP1 PWM0 в /dev/mem);
+    за тестове може да е обикновен файл с размер поне една страница.
+    Записът на duty cycle е едно 32-битово присвояване без системно извикване.
+    Контролерът се представя като един чип с channels канала.
+    """
+    
+    name = "mmap"
+    
+    def __init__(self, path=MMAP_DEFAULT_PATH, offset=MMAP_DEFAULT_OFFSET,
+                 clock_hz=MMAP_DEFAULT_CLOCK_HZ, channels=MMAP_DEFAULT_CHANNELS, chip="pwmchip0"):
+        self.path = path
+        self.offset = offset
+        self.clock_hz = clock_hz
+        self.channels = channels
+        self.chip = chip
+        # mmap изисква отместване, подравнено на страница
+        page_offset = offset % mmap.ALLOCATIONGRANULARITY
+        size = MMAP_CHANNEL_BASE + channels * MMAP_CHANNEL_STRIDE
+        fd = os.open(path, os.O_RDWR | os.O_SYNC)
+        try:
+            self.map = mmap.mmap(fd, page_offset + size, mmap.MAP_SHARED,
+                                 mmap.PROT_READ | mmap.PROT_WRITE, offset=offset - page_offset)
+        finally:
+            os.close(fd)
+        self.regs = memoryview(self.map)[page_offset:page_offset + size].cast("I")
+        # GLOBAL_CTRL е общ за всички канали (read-modify-write)
+        self.lock = threading.Lock()
+    
+    def scan_chips(self):
+        """Един чип с channels канала"""
+        return {self.chip: self.channels}
+    
+    def open_channel(self, pwm_chip, channel, metrics=None):
+        """Канал от регистровия блок (без export)"""
+        if pwm_chip != self.chip or not 0 <= channel < self.channels:
+            logger.error(f"Няма канал {pwm_chip}:{channel} в регистровия блок")
             return None
+        return RegisterChannel(self, pwm_chip, channel, metrics)
+    
+    def release_channel(self, pwm_chip, channel, handle):
+        """Изключи канала"""
+        handle.write("enable", 0)
+    
+    def close(self):
+        """Освободи mapping-а"""
+        self.regs.release()
+        self.map.close()
+
+
+def parse_pin_map(value):
+    """Парсни "12=pwmchip0:0,13=1" в {gpio_pin: (chip или None, channel)}"""
+    pin_map = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        pin, _, target = item.partition("=")
+        chip, _, channel = target.rpartition(":")
+        pin_map[int(pin)] = (chip or None, int(channel))
+    return pin_map
+
+
+class PWMTopology:
+    """Индекс на PWM чиповете и съответствието GPIO -> (chip, channel)
+    
+    Чиповете се сканират веднъж (backend.scan_chips(), напр.
+    /sys/class/pwm/*/npwm) при старт и при POST /rescan, вместо при всеки /init.
+    """
+    
+    def __init__(self, backend, pin_map=None):
+        self.backend = backend
+        self.pin_map = pin_map or {}  # {gpio_pin: (chip или None, channel)}
+        self.chips = {}  # {chip: npwm}
+        self.scan()
+    
+    def scan(self):
+        """Прочети наличните PWM чипове и броя им канали"""
+        self.chips = self.backend.scan_chips()
+        logger.info(f"PWM топология: {self.chips or 'няма чипове'}")
+        return self.chips
+    
+    def resolve(self, gpio_pin):
+        """(chip, channel) за GPIO пина или None"""
+        chip, channel = self.pin_map.get(gpio_pin, (None, DEFAULT_PIN_CHANNELS.get(gpio_pin, DEFAULT_PIN_CHANNEL)))
+        if chip is not None:
+            return (chip, channel) if self.chips.get(chip, 0) > channel else None
+        for chip, npwm in self.chips.items():
+            if npwm > channel:
+                return chip, channel
+        return None
+    
+    def as_dict(self):
+        """Индексът за /topology"""
+        pins = set(DEFAULT_PIN_CHANNELS) | set(self.pin_map)
+        return {
+            "chips": self.chips,
+            "pins": {pin: self.resolve(pin) for pin in sorted(pins)}
+        }
+
+
+class StateJournal:
+    """Append-only журнал (JSON lines) на желаното състояние на каналите
     
-    def initialize_pwm(self, gpio_pin, frequency):
-        """Инициализира PWM на GPIO пин"""
+    Промените се събират latest-wins за пин и се дописват от фонова нишка
+    най-много веднъж на flush_interval, така че поток от setpoints не пише
+    при всяка промяна. След compact_after записа файлът се пренаписва само с
+    последното състояние на всеки пин.
+    """
+    
+    def __init__(self, path, compact_after=1000, flush_interval=0.5):
+        self.path = path
+        self.compact_after = compact_after
+        self.flush_interval = flush_interval
+        self.state = {}  # {gpio_pin: record}
+        self.entries = 0
+        self.pending = {}  # {gpio_pin: record или None}
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.fd = None
+        self.thread = None
+    
+    def load(self):
+        """Прочети журнала; връща {gpio_pin: record} с последното състояние"""
+        state = {}
+        entries = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        gpio_pin = record["gpio_pin"]
+                    except (ValueError, KeyError, TypeError):
+                        # Недописан ред при спиране на тока
+                        continue
+                    entries += 1
+                    if record.get("removed"):
+                        state.pop(gpio_pin, None)
+                    else:
+                        state[gpio_pin] = record
+        except FileNotFoundError:
+            pass
+        self.state = state
+        self.entries = entries
+        return dict(state)
+    
+    def record(self, gpio_pin, record):
+        """Отбележи новото състояние на пина (None = освободен)"""
+        with self.cond:
+            self.pending[gpio_pin] = record
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="pwm-journal", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+    
+    def _run(self):
+        """Периодично дописване"""
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            time.sleep(self.flush_interval)
+            self.flush()
+    
+    def flush(self):
+        """Допиши чакащите промени"""
+        with self.flush_lock:
+            self._flush()
+    
+    def _flush(self):
+        """Допиши чакащите промени (под flush_lock)"""
+        with self.cond:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        
+        lines = []
+        for gpio_pin, record in pending.items():
+            if record is None:
+                if self.state.pop(gpio_pin, None) is None:
+                    continue
+                record = {"gpio_pin": gpio_pin, "removed": True}
+            else:
+                record = dict(record, gpio_pin=gpio_pin)
+                self.state[gpio_pin] = record
+            lines.append(json.dumps(record) + "\n")
+        
+        try:
+            if self.entries + len(lines) > self.compact_after:
+                self.compact()
+                return
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self.fd, "".join(lines).encode())
+            self.entries += len(lines)
+        except OSError as e:
+            logger.error(f"Грешка при запис в журнала {self.path}: {e}")
+    
+    def compact(self):
+        """Пренапиши журнала само с текущото състояние (атомарно чрез rename)"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            for record in self.state.values():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.entries = len(self.state)
+    
+    def close(self):
+        """Допиши всичко и затвори файла"""
+        with self.flush_lock:
+            self._flush()
+            if self.fd is not None:
+                os.fsync(self.fd)
+                os.close(self.fd)
+                self.fd = None
+
+
+class Fade:
+    """Един плавен преход на duty cycle"""
+    
+    __slots__ = ("start_duty", "target_duty", "start_time", "duration", "curve")
+    
+    def __init__(self, start_duty, target_duty, duration, curve):
+        self.start_duty = start_duty
+        self.target_duty = target_duty
+        self.start_time = time.monotonic()
+        self.duration = duration
+        self.curve = FADE_CURVES[curve]
+    
+    def value_at(self, now):
+        """Duty cycle в момента now; връща (duty_cycle, done)"""
+        if self.duration <= 0:
+            return self.target_duty, True
+        progress = (now - self.start_time) / self.duration
+        if progress >= 1:
+            return self.target_duty, True
+        return self.curve(self.start_duty, self.target_duty, progress), False
+
+
+class FadeEngine:
+    """Таймер, който изпълнява активните преходи с фиксирана честота"""
+    
+    def __init__(self, controller, tick_hz=100):
+        self.controller = controller
+        self.interval = 1.0 / tick_hz
+        self.fades = {}  # {gpio_pin: Fade}
+        self.cond = threading.Condition()
+        self.thread = None
+    
+    def start(self, gpio_pin, fade):
+        """Започни преход (заменя текущия преход на пина)"""
+        with self.cond:
+            self.fades[gpio_pin] = fade
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="pwm-fade", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+    
+    def cancel(self, gpio_pin):
+        """Прекрати прехода на пина; връща True ако е имало такъв"""
+        with self.cond:
+            return self.fades.pop(gpio_pin, None) is not None
+    
+    def is_active(self, gpio_pin, fade):
+        """Провери дали fade все още е текущият преход на пина"""
+        with self.cond:
+            return self.fades.get(gpio_pin) is fade
+    
+    def _finish(self, gpio_pin, fade):
+        """Премахни завършил преход"""
+        with self.cond:
+            if self.fades.get(gpio_pin) is fade:
+                del self.fades[gpio_pin]
+    
+    def _run(self):
+        """Основен цикъл на таймера"""
+        next_tick = time.monotonic()
+        while True:
+            with self.cond:
+                while not self.fades:
+                    self.cond.wait()
+                    next_tick = time.monotonic()
+                fades = list(self.fades.items())
+            
+            now = time.monotonic()
+            for gpio_pin, fade in fades:
+                duty_cycle, done = fade.value_at(now)
+                if not self.controller._fade_step(gpio_pin, fade, duty_cycle) or done:
+                    self._finish(gpio_pin, fade)
+                    if done:
+                        logger.info(f"PWM GPIO{gpio_pin}: преход завършен, duty cycle = {duty_cycle}%")
+            
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Изоставане (напр. бавен sysfs) - не наваксвай пропуснатите тактове
+                next_tick = time.monotonic()
+
+
+class DutyCoalescer:
+    """Latest-wins пощенска кутия за duty cycle с ограничена честота на запис
+    
+    Всеки канал с max_rate_hz > 0 има един слот: нова стойност замества
+    незаписаната предишна. Една нишка записва слотовете не по-често от
+    max_rate_hz за канал.
+    """
+    
+    def __init__(self, controller):
+        self.controller = controller
+        self.pending = {}  # {gpio_pin: duty_cycle}
+        self.next_write = {}  # {gpio_pin: monotonic time}
+        self.cond = threading.Condition()
+        self.thread = None
+    
+    def submit(self, gpio_pin, duty_cycle):
+        """Сложи стойност в слота; връща True ако е заменила незаписана стойност"""
+        with self.cond:
+            replaced = gpio_pin in self.pending
+            self.pending[gpio_pin] = duty_cycle
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="pwm-coalesce", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+            return replaced
+    
+    def discard(self, gpio_pin):
+        """Изхвърли незаписаната стойност (при директен запис, преход или unexport)"""
+        with self.cond:
+            self.pending.pop(gpio_pin, None)
+    
+    def _run(self):
+        """Записвай готовите слотове"""
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    ready = [pin for pin in self.pending if self.next_write.get(pin, 0) <= now]
+                    if ready:
+                        break
+                    if self.pending:
+                        self.cond.wait(min(self.next_write[pin] for pin in self.pending) - now)
+                    else:
+                        self.cond.wait()
+                items = [(pin, self.pending.pop(pin)) for pin in ready]
+            
+            for gpio_pin, duty_cycle in items:
+                rate = self.controller._coalesced_write(gpio_pin, duty_cycle)
+                if rate:
+                    with self.cond:
+                        self.next_write[gpio_pin] = time.monotonic() + 1.0 / rate
+
+
+class RateLimitedLog:
+    """Ограничено логване на често повтарящо се събитие по ключ (напр. пин)
+    
+    Първото събитие след тих интервал се логва веднага; следващите в рамките
+    на interval само се броят и фонова нишка извежда един обобщен ред на
+    interval секунди. message и summary са format низове с полета key, value,
+    count и interval.
+    """
+    
+    def __init__(self, logger, message, summary, interval=LOG_SUMMARY_INTERVAL, level=logging.INFO):
+        self.logger = logger
+        self.message = message
+        self.summary = summary
+        self.interval = interval
+        self.level = level
+        self.entries = {}  # {key: [брой от последния ред, monotonic на последния ред, последна стойност]}
+        self.lock = threading.Lock()
+        self.thread = None
+    
+    def record(self, key, value):
+        """Отчети събитие за key с последна стойност value"""
+        now = time.monotonic()
         with self.lock:
-            if gpio_pin in self.pwm_instances:
-                logger.info(f"PWM на GPIO{gpio_pin} вече е инициализиран")
-                return True
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] or now - entry[1] < self.interval):
+                entry[0] += 1
+                entry[2] = value
+                return
+            self.entries[key] = [0, now, value]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="pwm-log-summary", daemon=True)
+                self.thread.start()
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, self.message.format(key=key, value=value))
+    
+    def _run(self):
+        """Извеждай обобщените редове"""
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            with self.lock:
+                ready = [(key, entry[0], entry[2]) for key, entry in self.entries.items() if entry[0]]
+                for key, count, value in ready:
+                    self.entries[key] = [0, now, value]
+            if self.logger.isEnabledFor(self.level):
+                for key, count, value in ready:
+                    self.logger.log(self.level, self.summary.format(
+                        key=key, value=value, count=count, interval=self.interval))
+
+
+class PWMInstance:
+    """Състояние на един инициализиран PWM канал"""
+    
+    __slots__ = ("gpio_pin", "pwm_chip", "channel", "pwm_path", "frequency",
+                 "period_ns", "duty_cycle", "duty_ns", "enabled", "handle", "duty_lut",
+                 "max_rate_hz", "duty_writes", "duty_skipped", "duty_coalesced")
+    
+    def __init__(self, gpio_pin, pwm_chip, channel, pwm_path, frequency, period_ns, handle,
+                 max_rate_hz=0, duty_cycle=0, duty_ns=0, enabled=False):
+        self.gpio_pin = gpio_pin
+        self.pwm_chip = pwm_chip
+        self.channel = channel
+        self.pwm_path = pwm_path
+        self.frequency = frequency
+        self.period_ns = period_ns
+        self.duty_cycle = duty_cycle
+        self.duty_ns = duty_ns
+        self.enabled = enabled
+        self.handle = handle
+        self.duty_lut = build_duty_lut(period_ns)
+        # > 0: /duty минава през DutyCoalescer с най-много max_rate_hz записа в секунда
+        self.max_rate_hz = max_rate_hz
+        # Брояч на записите в sysfs, пропуснатите (без промяна) и заместените в слота
+        self.duty_writes = 0
+        self.duty_skipped = 0
+        self.duty_coalesced = 0
+    
+    def as_dict(self):
+        """Публичното състояние за /status"""
+        return {
+            "pwm_chip": self.pwm_chip,
+            "channel": self.channel,
+            "pwm_path": self.pwm_path,
+            "frequency": self.frequency,
+            "period_ns": self.period_ns,
+            "duty_cycle": self.duty_cycle,
+            "enabled": self.enabled,
+            "max_rate_hz": self.max_rate_hz,
+            "duty_writes": self.duty_writes,
+            "duty_skipped": self.duty_skipped,
+            "duty_coalesced": self.duty_coalesced
+        }
+    
+    def journal_record(self):
+        """Желаното състояние за StateJournal"""
+        return {
+            "pwm_chip": self.pwm_chip,
+            "channel": self.channel,
+            "frequency": self.frequency,
+            "duty_cycle": self.duty_cycle,
+            "enabled": self.enabled,
+            "max_rate_hz": self.max_rate_hz
+        }
+
+
+class PWMController:
+    """Hardware PWM контролер (sysfs или друг backend)
+    
+    Всеки пин има собствено заключване, така че бавна инициализация или запис
+    на един канал не блокира останалите. self.lock пази само регистъра
+    (pwm_instances, channel_locks). Статусът се чете от неизменим snapshot,
+    който се публикува след всяка промяна, без заключване.
+    """
+    
+    def __init__(self, fade_tick_hz=100, max_rate_hz=0, pin_map=None, journal=None,
+                 log_summary_interval=LOG_SUMMARY_INTERVAL, backend=None):
+        """backend: SysfsBackend() по подразбиране или напр. MmapBackend"""
+        self.journal = journal
+        self.backend = backend or SysfsBackend()
+        self.topology = PWMTopology(self.backend, pin_map)
+        # Честота по подразбиране за DutyCoalescer (0 = директен запис)
+        self.max_rate_hz = max_rate_hz
+        self.pwm_instances = {}  # {gpio_pin: PWMInstance}
+        self.channel_locks = {}  # {gpio_pin: TimedLock}
+        self.metrics = PWMMetrics()
+        self.lock = threading.Lock()
+        # Последният публикуван статус {gpio_pin: dict}; не се променя след публикуване
+        self.snapshot = {}
+        self.snapshot_lock = threading.Lock()
+        # Версия на статуса (расте при всяко публикуване) заедно със snapshot-а;
+        # boot_id различава версиите след рестарт на daemon (ETag на /status)
+        self.status_version = (0, self.snapshot)
+        self.boot_id = os.urandom(4).hex()
+        # Кодираните тела на /status за текущата версия: (version, {(pin, fields): bytes})
+        self.status_cache = (0, {})
+        # Последните промени (event_id, data) за GET /events
+        self.events = deque(maxlen=EVENT_HISTORY)
+        self.event_id = 0
+        self.events_cond = threading.Condition(self.snapshot_lock)
+        self.fader = FadeEngine(self, fade_tick_hz)
+        self.coalescer = DutyCoalescer(self)
+        # Промените на duty cycle се логват най-много веднъж на интервал за пин
+        self.duty_log = RateLimitedLog(
+            logger, "PWM GPIO{key}: duty cycle = {value}%",
+            "PWM GPIO{key}: {count} промени на duty cycle за последните {interval:g}s (последна: {value}%)",
+            log_summary_interval)
+    
+    def _channel_lock(self, gpio_pin):
+        """Заключване на канала на gpio_pin (TimedLock, създава се при първо използване)"""
+        lock = self.channel_locks.get(gpio_pin)
+        if lock is None:
+            with self.lock:
+                lock = self.channel_locks.setdefault(gpio_pin, TimedLock(self.metrics.lock_wait))
+        return lock
+    
+    def _publish(self, gpio_pin):
+        """Публикувай нов snapshot след промяна на пина и събитие с разликата"""
+        instance = self.pwm_instances.get(gpio_pin)
+        with self.snapshot_lock:
+            snapshot = dict(self.snapshot)
+            previous = snapshot.get(gpio_pin)
+            if instance is None:
+                snapshot.pop(gpio_pin, None)
+                delta = {"removed": True} if previous else None
+            else:
+                current = snapshot[gpio_pin] = instance.as_dict()
+                delta = {field: current[field] for field in EVENT_FIELDS
+                         if previous is None or previous[field] != current[field]}
+            self.snapshot = snapshot
+            self.status_version = (self.status_version[0] + 1, snapshot)
+            
+            if delta:
+                if self.journal:
+                    self.journal.record(gpio_pin, instance.journal_record() if instance else None)
+                delta["gpio_pin"] = gpio_pin
+                self.event_id += 1
+                self.events.append((self.event_id, delta))
+                self.events_cond.notify_all()
+    
+    def wait_events(self, last_event_id, timeout):
+        """Събития след last_event_id; чака до timeout ако няма нови
+        
+        Връща (events, snapshot): snapshot е пълният статус, когато
+        last_event_id е None (друго стартиране), твърде стар или непознат и
+        пропуснатите промени не могат да се възпроизведат.
+        """
+        with self.events_cond:
+            if last_event_id == self.event_id:
+                self.events_cond.wait(timeout)
+            oldest = self.events[0][0] if self.events else self.event_id + 1
+            if last_event_id is None or last_event_id > self.event_id or last_event_id < oldest - 1:
+                return [], (self.event_id, self.snapshot)
+            return [event for event in self.events if event[0] > last_event_id], None
+    
+    def initialize_pwm(self, gpio_pin, frequency=None, max_rate_hz=None):
+        """Инициализира PWM на GPIO пин; за вече инициализиран пин сменя честотата
+        
+        frequency: None = текущата честота на инициализиран пин или DEFAULT_FREQUENCY.
+        max_rate_hz: лимит на записите на duty cycle (None = стойността на daemon-а)
+        """
+        if frequency is None and gpio_pin not in self.pwm_instances:
+            frequency = DEFAULT_FREQUENCY
+        success, _ = self.apply_state(gpio_pin, frequency=frequency, max_rate_hz=max_rate_hz)
+        return success
+    
+    def apply_state(self, gpio_pin, frequency=None, duty_cycle=None, enabled=None, max_rate_hz=None):
+        """Доведи пина до желаното състояние с минимален брой записи
+        
+        Параметрите с None запазват текущата стойност; за неинициализиран пин
+        frequency е задължителна и каналът се отваря. При смяна на честотата
+        duty cycle в % се запазва. Разликата спрямо pwm_instances се записва
+        от handle.apply() в допустимия ред (напр. duty преди по-малък период).
+        Връща (success, writes) с извършените записи [(attr, value)].
+        """
+        with self._channel_lock(gpio_pin):
+            instance = self.pwm_instances.get(gpio_pin)
+            if instance is None and frequency is None:
+                logger.error(f"PWM на GPIO{gpio_pin} не е инициализиран")
+                return False, []
             
             try:
-                pwm_chip = self._find_pwm_chip()
-                if not pwm_chip:
-                    logger.error("PWM chip не е намерен")
-                    return False
-                
-                # Определи PWM channel (0 за GPIO12/18, 1 за GPIO13/19)
-                channel = 0 if gpio_pin in [12, 18] else 1
-                pwm_path = f"/sys/class/pwm/{pwm_chip}/pwm{channel}"
-                
-                # Export ако не е експортиран
-                if not os.path.exists(pwm_path):
-                    export_path = f"/sys/class/pwm/{pwm_chip}/export"
-                    self._write_file(export_path, str(channel))
-                    import time
-                    time.sleep(0.5)
-                
-                if not os.path.exists(pwm_path):
-                    logger.error(f"PWM path {pwm_path} не съществува")
-                    return False
+                if instance is None:
+                    target = self.topology.resolve(gpio_pin)
+                    if not target:
+                        logger.error(f"Няма PWM chip/channel за GPIO{gpio_pin}")
+                        return False, []
+                    pwm_chip, channel = target
+                    handle = self._open_channel(pwm_chip, channel)
+                    if handle is None:
+                        return False, []
+                    live = handle.read_state()
+                else:
+                    handle = instance.handle
+                    live = {"period": instance.period_ns, "duty_cycle": instance.duty_ns,
+                            "enable": int(instance.enabled)}
+                    if frequency is None:
+                        frequency = instance.frequency
                 
-                # Изчисли период
                 period_ns = int(1e9 / frequency)
+                duty_requested = duty_cycle is not None
+                if duty_requested:
+                    duty_cycle = max(0, min(100, duty_cycle))
+                    duty_ns = int(period_ns * duty_cycle / 100)
+                elif instance is not None:
+                    duty_cycle = instance.duty_cycle
+                    duty_ns = instance.duty_ns if period_ns == instance.period_ns else int(period_ns * duty_cycle / 100)
+                elif live["period"] == period_ns:
+                    # Каналът вече е настроен (напр. след рестарт на daemon) - запази duty cycle
+                    duty_ns = live["duty_cycle"]
+                    duty_cycle = round(duty_ns * 100 / period_ns, 2)
+                else:
+                    duty_cycle, duty_ns = 0, 0
+                if enabled is None:
+                    enabled = bool(live["enable"])
                 
-                # Настрой период
-                period_path = f"{pwm_path}/period"
-                if not self._write_file(period_path, str(period_ns)):
-                    return False
-                
-                # Настрой duty cycle на 0
-                duty_path = f"{pwm_path}/duty_cycle"
-                self._write_file(duty_path, "0")
-                
-                # Запази информация
-                self.pwm_instances[gpio_pin] = {
-                    "pwm_chip": pwm_chip,
-                    "channel": channel,
-                    "pwm_path": pwm_path,
-                    "frequency": frequency,
-                    "period_ns": period_ns,
-                    "duty_cycle": 0,
-                    "enabled": False
-                }
+                if duty_requested:
+                    self.fader.cancel(gpio_pin)
+                    self.coalescer.discard(gpio_pin)
+                writes = handle.apply(live, period_ns, duty_ns, enabled)
+                if writes is None:
+                    if instance is None:
+                        handle.close()
+                    return False, []
                 
-                logger.info(f"✓ PWM инициализиран: GPIO{gpio_pin}, {frequency}Hz")
-                return True
+                if instance is None:
+                    if max_rate_hz is None:
+                        max_rate_hz = self.max_rate_hz
+                    instance = PWMInstance(gpio_pin, pwm_chip, channel, handle.pwm_path,
+                                           frequency, period_ns, handle, max_rate_hz,
+                                           duty_cycle=duty_cycle, duty_ns=duty_ns, enabled=enabled)
+                    with self.lock:
+                        self.pwm_instances[gpio_pin] = instance
+                    logger.info(f"✓ PWM инициализиран: GPIO{gpio_pin}, {frequency}Hz")
+                else:
+                    if frequency != instance.frequency:
+                        logger.info(f"PWM GPIO{gpio_pin}: честота {instance.frequency} -> {frequency} Hz")
+                        instance.frequency = frequency
+                        if period_ns != instance.period_ns:
+                            instance.period_ns = period_ns
+                            instance.duty_lut = build_duty_lut(period_ns)
+                    if max_rate_hz is not None:
+                        instance.max_rate_hz = max_rate_hz
+                    if instance.enabled != enabled:
+                        logger.info(f"✓ PWM GPIO{gpio_pin} {'включен' if enabled else 'изключен'}")
+                    instance.duty_cycle = duty_cycle
+                    instance.duty_ns = duty_ns
+                    instance.enabled = enabled
                 
+                if any(attr == "duty_cycle" for attr, _ in writes):
+                    instance.duty_writes += 1
+                    self.duty_log.record(gpio_pin, duty_cycle)
+                elif duty_requested:
+                    instance.duty_skipped += 1
+                self._publish(gpio_pin)
+                return True, writes
+            
             except Exception as e:
-                logger.error(f"Грешка при инициализация на PWM: {e}")
-                return False
+                logger.error(f"Грешка при прилагане на състоянието на GPIO{gpio_pin}: {e}")
+                return False, []
     
-    def set_duty_cycle(self, gpio_pin, duty_cycle):
-        """Настрой duty cycle (0-100%)"""
-        with self.lock:
-            if gpio_pin not in self.pwm_instances:
+    def _open_channel(self, pwm_chip, channel):
+        """Отвори канала чрез backend-а; None при грешка"""
+        return self.backend.open_channel(pwm_chip, channel, self.metrics.channel(pwm_chip, channel))
+    
+    def restore_state(self):
+        """Възстанови каналите от журнала след рестарт
+        
+        Живите стойности в sysfs се четат и се записват само атрибутите, които
+        се различават от журнала, така че изходът не примигва.
+        """
+        if not self.journal:
+            return
+        
+        for gpio_pin, record in self.journal.load().items():
+            with self._channel_lock(gpio_pin):
+                try:
+                    handle = self._open_channel(record["pwm_chip"], record["channel"])
+                    if handle is None:
+                        continue
+                    
+                    frequency = record["frequency"]
+                    period_ns = int(1e9 / frequency)
+                    duty_ns = int(period_ns * record["duty_cycle"] / 100)
+                    writes = handle.apply(handle.read_state(), period_ns, duty_ns, record["enabled"])
+                    if writes is None:
+                        handle.close()
+                        continue
+                    
+                    instance = PWMInstance(gpio_pin, record["pwm_chip"], record["channel"],
+                                           handle.pwm_path, frequency, period_ns, handle,
+                                           record.get("max_rate_hz", self.max_rate_hz),
+                                           duty_cycle=record["duty_cycle"], duty_ns=duty_ns,
+                                           enabled=record["enabled"])
+                    with self.lock:
+                        self.pwm_instances[gpio_pin] = instance
+                    self._publish(gpio_pin)
+                    logger.info(f"✓ PWM GPIO{gpio_pin} възстановен от журнала "
+                                f"({len(writes)} записа в sysfs)")
+                except (OSError, KeyError, TypeError, ValueError) as e:
+                    logger.error(f"Грешка при възстановяване на GPIO{gpio_pin}: {e}")
+    
+    def set_duty_cycle(self, gpio_pin, duty_cycle, coalesce=True):
+        """Настрой duty cycle (0-100%); прекратява текущ преход
+        
+        При max_rate_hz > 0 и coalesce=True стойността само се поставя в слота
+        на DutyCoalescer и се записва асинхронно.
+        """
+        with self._channel_lock(gpio_pin):
+            instance = self.pwm_instances.get(gpio_pin)
+            if instance is None:
                 logger.error(f"PWM на GPIO{gpio_pin} не е инициализиран")
                 return False
             
             try:
-                instance = self.pwm_instances[gpio_pin]
+                self.fader.cancel(gpio_pin)
                 duty_cycle = max(0, min(100, duty_cycle))
-                duty_ns = int(instance["period_ns"] * duty_cycle / 100)
+                if coalesce and instance.max_rate_hz > 0:
+                    if self.coalescer.submit(gpio_pin, duty_cycle):
+                        instance.duty_coalesced += 1
+                    return True
                 
-                duty_path = f"{instance['pwm_path']}/duty_cycle"
-                if self._write_file(duty_path, str(duty_ns)):
-                    instance["duty_cycle"] = duty_cycle
-                    logger.info(f"PWM GPIO{gpio_pin}: duty cycle = {duty_cycle}%")
+                self.coalescer.discard(gpio_pin)
+                if self._write_duty(gpio_pin, duty_cycle):
+                    self.duty_log.record(gpio_pin, duty_cycle)
                     return True
                 return False
                 
@@ -132,17 +1298,93 @@ class PWMController:
                 logger.error(f"Грешка при настройка на duty cycle: {e}")
                 return False
     
+    def _write_duty(self, gpio_pin, duty_cycle, duty_ns=None, fade=False):
+        """Запиши duty cycle в sysfs (извиква се под заключването на канала)
+        
+        Запис, който не променя стойността в ns, се пропуска, а ако не променя
+        и duty_cycle - не се и публикува. fade: стъпка от преход, пропуснатият
+        запис не се брои в duty_skipped (броячът е за заявките на клиентите).
+        """
+        instance = self.pwm_instances[gpio_pin]
+        if duty_ns is None:
+            duty_ns = int(instance.period_ns * duty_cycle / 100)
+        
+        if duty_ns == instance.duty_ns:
+            if not fade:
+                instance.duty_skipped += 1
+            if duty_cycle == instance.duty_cycle:
+                return True
+        elif instance.handle.write("duty_cycle", duty_ns):
+            instance.duty_ns = duty_ns
+            instance.duty_writes += 1
+        else:
+            return False
+        instance.duty_cycle = duty_cycle
+        self._publish(gpio_pin)
+        return True
+    
+    def _coalesced_write(self, gpio_pin, duty_cycle):
+        """Запис от DutyCoalescer; връща max_rate_hz на канала (0 ако го няма)"""
+        with self._channel_lock(gpio_pin):
+            instance = self.pwm_instances.get(gpio_pin)
+            if instance is None:
+                return 0
+            try:
+                if self._write_duty(gpio_pin, duty_cycle):
+                    self.duty_log.record(gpio_pin, duty_cycle)
+            except Exception as e:
+                logger.error(f"Грешка при настройка на duty cycle: {e}")
+            return instance.max_rate_hz
+    
+    def fade_duty_cycle(self, gpio_pin, duty_cycle, duration, curve="linear"):
+        """Плавен преход до duty_cycle за duration секунди"""
+        with self._channel_lock(gpio_pin):
+            if gpio_pin not in self.pwm_instances:
+                logger.error(f"PWM на GPIO{gpio_pin} не е инициализиран")
+                return False
+            
+            try:
+                self.coalescer.discard(gpio_pin)
+                start = self.pwm_instances[gpio_pin].duty_cycle
+                target = max(0, min(100, duty_cycle))
+                self.fader.start(gpio_pin, Fade(start, target, duration, curve))
+                logger.info(f"PWM GPIO{gpio_pin}: преход {start}% -> {target}% за {duration}s ({curve})")
+                return True
+                
+            except Exception as e:
+                logger.error(f"Грешка при стартиране на преход: {e}")
+                return False
+    
+    def _fade_step(self, gpio_pin, fade, duty_cycle):
+        """Една стъпка от преход; записва само ако стойността в ns се променя"""
+        with self._channel_lock(gpio_pin):
+            # Преходът може да е прекратен от /duty докато таймерът е чакал заключването
+            instance = self.pwm_instances.get(gpio_pin)
+            if instance is None or not self.fader.is_active(gpio_pin, fade):
+                return False
+            
+            duty_ns = instance.duty_lut[round(duty_cycle * DUTY_LUT_SCALE)]
+            if duty_cycle != fade.target_duty:
+                # Междинната стойност се закръгля до стъпката на LUT-а; без промяна в ns няма
+                # какво да се запише, публикува или отбележи в журнала
+                if duty_ns == instance.duty_ns:
+                    return True
+                duty_cycle = round(duty_cycle * DUTY_LUT_SCALE) / DUTY_LUT_SCALE
+            return self._write_duty(gpio_pin, duty_cycle, duty_ns, fade=True)
+    
     def enable_pwm(self, gpio_pin):
         """Включи PWM"""
-        with self.lock:
+        with self._channel_lock(gpio_pin):
             if gpio_pin not in self.pwm_instances:
                 return False
             
             try:
                 instance = self.pwm_instances[gpio_pin]
-                enable_path = f"{instance['pwm_path']}/enable"
-                if self._write_file(enable_path, "1"):
-                    instance["enabled"] = True
+                if instance.enabled:
+                    return True
+                if instance.handle.write("enable", 1):
+                    instance.enabled = True
+                    self._publish(gpio_pin)
                     logger.info(f"✓ PWM GPIO{gpio_pin} включен")
                     return True
                 return False
@@ -152,15 +1394,17 @@ class PWMController:
     
     def disable_pwm(self, gpio_pin):
         """Изключи PWM"""
-        with self.lock:
+        with self._channel_lock(gpio_pin):
             if gpio_pin not in self.pwm_instances:
                 return False
             
             try:
                 instance = self.pwm_instances[gpio_pin]
-                enable_path = f"{instance['pwm_path']}/enable"
-                if self._write_file(enable_path, "0"):
-                    instance["enabled"] = False
+                if not instance.enabled:
+                    return True
+                if instance.handle.write("enable", 0):
+                    instance.enabled = False
+                    self._publish(gpio_pin)
                     logger.info(f"✓ PWM GPIO{gpio_pin} изключен")
                     return True
                 return False
@@ -168,24 +1412,907 @@ class PWMController:
                 logger.error(f"Грешка при изключване на PWM: {e}")
                 return False
     
+    def unexport_pwm(self, gpio_pin):
+        """Освободи PWM канала и затвори кешираните дескриптори"""
+        with self._channel_lock(gpio_pin):
+            if gpio_pin not in self.pwm_instances:
+                return False
+            
+            try:
+                self.fader.cancel(gpio_pin)
+                self.coalescer.discard(gpio_pin)
+                with self.lock:
+                    instance = self.pwm_instances.pop(gpio_pin)
+                self._publish(gpio_pin)
+                self.backend.release_channel(instance.pwm_chip, instance.channel, instance.handle)
+                logger.info(f"✓ PWM GPIO{gpio_pin} освободен")
+                return True
+            except Exception as e:
+                logger.error(f"Грешка при освобождаване на PWM: {e}")
+                return False
+    
+    def _apply_operation(self, operation):
+        """Изпълни една batch операция; връща (success, message)"""
+        op = operation.get("op")
+        gpio_pin = operation.get("gpio_pin")
+        
+        if op not in BATCH_OPERATIONS:
+            return False, f"Unknown operation: {op}"
+        if gpio_pin is None:
+            return False, "gpio_pin required"
+        if not is_pin(gpio_pin):
+            return False, "gpio_pin must be an integer"
+        
+        if op == "init":
+            success = self.initialize_pwm(gpio_pin, operation.get("frequency"),
+                                          operation.get("max_rate_hz"))
+            return success, "PWM initialized" if success else "Failed to initialize PWM"
+        
+        if op == "duty":
+            duty_cycle = operation.get("duty_cycle")
+            if duty_cycle is None:
+                return False, "duty_cycle required"
+            if not is_number(duty_cycle):
+                return False, "Invalid duty_cycle"
+            # Batch записва директно, за да може atomic режимът да открие грешка
+            success = self.set_duty_cycle(gpio_pin, duty_cycle, coalesce=False)
+            return success, "Duty cycle set" if success else "Failed to set duty cycle"
+        
+        if op == "enable":
+            success = self.enable_pwm(gpio_pin)
+            return success, "PWM enabled" if success else "Failed to enable PWM"
+        
+        success = self.disable_pwm(gpio_pin)
+        return success, "PWM disabled" if success else "Failed to disable PWM"
+    
+    def _rollback_operation(self, operation, previous):
+        """Върни пина в състоянието преди операцията"""
+        gpio_pin = operation["gpio_pin"]
+        if previous is None:
+            # Пинът е инициализиран от batch-а
+            if gpio_pin in self.pwm_instances:
+                self.unexport_pwm(gpio_pin)
+            return
+        
+        if operation["op"] == "init":
+            # Повторен init може да е сменил честотата
+            self.apply_state(gpio_pin, previous["frequency"], previous["duty_cycle"],
+                             previous["enabled"], previous["max_rate_hz"])
+        elif operation["op"] == "duty":
+            self.set_duty_cycle(gpio_pin, previous["duty_cycle"], coalesce=False)
+        elif operation["op"] in ("enable", "disable"):
+            if previous["enabled"]:
+                self.enable_pwm(gpio_pin)
+            else:
+                self.disable_pwm(gpio_pin)
+    
+    def execute_batch(self, operations, atomic=False):
+        """Изпълни списък от операции, държейки заключванията на всички засегнати канали
+        
+        При atomic=True първата неуспешна операция прекратява batch-а, а вече
+        записаните стойности се връщат в обратен ред.
+        Връща (success, results) с по един резултат за всяка операция.
+        """
+        pins = sorted({op.get("gpio_pin") for op in operations if is_pin(op.get("gpio_pin"))})
+        with contextlib.ExitStack() as stack:
+            for gpio_pin in pins:
+                stack.enter_context(self._channel_lock(gpio_pin))
+            
+            results = []
+            applied = []
+            failed = False
+            
+            for operation in operations:
+                op = operation.get("op")
+                gpio_pin = operation.get("gpio_pin")
+                if failed and atomic:
+                    results.append({"op": op, "gpio_pin": gpio_pin, "status": "skipped"})
+                    continue
+                
+                previous = self.pwm_instances.get(gpio_pin) if is_pin(gpio_pin) else None
+                previous = previous.as_dict() if previous else None
+                success, message = self._apply_operation(operation)
+                results.append({
+                    "op": op,
+                    "gpio_pin": gpio_pin,
+                    "status": "ok" if success else "error",
+                    "message": message
+                })
+                if success:
+                    applied.append((operation, previous))
+                else:
+                    failed = True
+            
+            if failed and atomic:
+                for operation, previous in reversed(applied):
+                    self._rollback_operation(operation, previous)
+                for result in results:
+                    if result["status"] == "ok":
+                        result["status"] = "rolled_back"
+                logger.warning(f"Batch от {len(operations)} операции е върнат")
+            
+            return not failed, results
+    
     def get_status(self, gpio_pin=None):
-        """Вземи статус на PWM"""
+        """Вземи статус на PWM (без заключване; върнатият dict не трябва да се променя)"""
+        snapshot = self.snapshot
+        if gpio_pin:
+            return snapshot.get(gpio_pin, {})
+        return snapshot
+    
+    def encoded_status(self, gpio_pin=None, fields=None):
+        """JSON тялото на /status (или /status/{pin}) за текущата версия на статуса
+        
+        fields: tuple с полетата, които да останат (None = всички). Връща
+        (version, body); body е None ако пинът не е инициализиран. Тялото се
+        кешира до следващата промяна на статуса.
+        """
+        version, snapshot = self.status_version
+        cached_version, cache = self.status_cache
+        if cached_version != version:
+            cache = {}
+            self.status_cache = (version, cache)
+        
+        key = (gpio_pin, fields)
+        body = cache.get(key)
+        if body is None:
+            status = snapshot if gpio_pin is None else snapshot.get(gpio_pin)
+            if status is None:
+                return version, None
+            if fields:
+                select = lambda pwm: {field: pwm[field] for field in fields if field in pwm}
+                status = select(status) if gpio_pin is not None else {
+                    pin: select(pwm) for pin, pwm in status.items()}
+            body = json.dumps({"status": "ok", "pwm": status}, separators=(',', ':')).encode()
+            if len(cache) < STATUS_CACHE_SIZE:
+                cache[key] = body
+        return version, body
+
+
+def is_number(value):
+    """Число от JSON (int или float, но не bool)"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_pin(value):
+    """GPIO номер от JSON (int, но не bool)"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_loopback(address):
+    """Локален ли е клиентският адрес (127.0.0.0/8, ::1, ::ffff:127.x.x.x)"""
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return ip.is_loopback or (ip.version == 6 and ip.ipv4_mapped is not None and ip.ipv4_mapped.is_loopback)
+
+
+def parse_endpoint_limit(value):
+    """Разбор на --endpoint-limit: "/status=50" или "/status=50:100" (rate:burst)"""
+    try:
+        endpoint, _, limit = value.partition("=")
+        rate, _, burst = limit.partition(":")
+        rate = float(rate)
+        burst = float(burst) if burst else max(rate, 1.0)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"невалиден лимит: {value}")
+    if not endpoint.startswith("/") or rate <= 0 or burst < 1:
+        raise argparse.ArgumentTypeError(f"невалиден лимит: {value}")
+    return endpoint, (rate, burst)
+
+
+class TokenBucket:
+    """Token bucket: rate токена в секунда, най-много burst натрупани"""
+    
+    __slots__ = ("rate", "burst", "tokens", "updated")
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def take(self, now):
+        """Вземи един токен; връща 0 при успех, иначе секундите до следващия токен"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionControl:
+    """Допускане на HTTP заявки преди обработката им
+    
+    Всяка заявка минава през token bucket за адреса на клиента и (ако е
+    зададен) за endpoint-а. Локалните клиенти (loopback) не се ограничават по
+    адрес - нито по заявки в секунда, нито по брой връзки - освен при
+    limit_loopback. Admission се прави в работната нишка, която вече обслужва
+    заявката, така че място за нея винаги има; последните control_reserve
+    работни нишки обаче не се дават на четения: заявка извън
+    CONTROL_ENDPOINTS получава 429 веднага, когато заетите нишки стигнат
+    max_inflight - control_reserve. Така управлението винаги намира свободна
+    нишка, дори при наплив от /status.
+    
+    STREAMING_ENDPOINTS държат работна нишка, докато клиентът е абониран:
+    те са най-много max_streams (поне едно място остава за обикновените
+    заявки) и намаляват max_inflight за останалите.
+    """
+    
+    def __init__(self, max_inflight, client_rate=ADMISSION_CLIENT_RATE, client_burst=ADMISSION_CLIENT_BURST,
+                 endpoint_limits=None, control_reserve=ADMISSION_CONTROL_RESERVE, client_connections=0,
+                 max_streams=None, limit_loopback=False):
+        self.max_inflight = max(1, max_inflight)
+        self.control_reserve = max(0, min(control_reserve, self.max_inflight - 1))
+        if max_streams is None:
+            max_streams = self.max_inflight // 2
+        self.max_streams = max(0, min(max_streams, self.max_inflight - 1))
+        self.client_rate = client_rate
+        self.client_burst = max(client_burst, 1)
+        self.client_connections = client_connections
+        self.limit_loopback = limit_loopback
+        self.clients = OrderedDict()  # {адрес: TokenBucket}
+        self.endpoints = {endpoint: TokenBucket(rate, burst)
+                          for endpoint, (rate, burst) in (endpoint_limits or {}).items()}
+        self.connections = {}  # {адрес: отворени връзки}
+        self.inflight = 0
+        self.streams = 0
+        self.lock = threading.Lock()
+        self.rejected = {(endpoint, reason): 0 for endpoint in METRIC_ENDPOINTS for reason in REJECT_REASONS}
+        self.reject_log = RateLimitedLog(
+            logger, "Клиент {key}: заявката е отхвърлена ({value})",
+            "Клиент {key}: {count} отхвърлени заявки за последните {interval}s (последна причина: {value})",
+            level=logging.WARNING)
+    
+    def admit(self, client, endpoint, streaming=False):
+        """Допусни заявка; връща (None, 0) или (причина, секунди за Retry-After)
+    
+        Допусната заявка заема място до release(streaming).
+        """
+        now = time.monotonic()
         with self.lock:
-            if gpio_pin:
-                return self.pwm_instances.get(gpio_pin, {})
-            return self.pwm_instances.copy()
+            if self.client_rate > 0 and self._limited(client):
+                bucket = self.clients.get(client)
+                if bucket is None:
+                    bucket = self.clients[client] = TokenBucket(self.client_rate, self.client_burst)
+                    if len(self.clients) > ADMISSION_MAX_CLIENTS:
+                        self.clients.popitem(last=False)
+                else:
+                    self.clients.move_to_end(client)
+                wait = bucket.take(now)
+                if wait:
+                    return self._reject(client, endpoint, "client_rate", wait)
+    
+            bucket = self.endpoints.get(endpoint)
+            if bucket is not None:
+                wait = bucket.take(now)
+                if wait:
+                    return self._reject(client, endpoint, "endpoint_rate", wait)
+    
+            if streaming:
+                if self.streams >= self.max_streams or self.inflight + self.streams >= self.max_inflight:
+                    return self._reject(client, endpoint, "streams", EVENT_KEEPALIVE)
+                self.streams += 1
+                return None, 0
+    
+            if (endpoint not in CONTROL_ENDPOINTS and
+                    self.inflight >= self.max_inflight - self.streams - self.control_reserve):
+                return self._reject(client, endpoint, "saturated", 1)
+    
+            self.inflight += 1
+            return None, 0
+    
+    def release(self, streaming=False):
+        """Освободи мястото на завършена заявка или затворен поток"""
+        with self.lock:
+            if streaming:
+                self.streams -= 1
+            else:
+                self.inflight -= 1
+    
+    def connect(self, client):
+        """Нова връзка от client; False, ако клиентът вече има твърде много"""
+        with self.lock:
+            count = self.connections.get(client, 0)
+            if self.client_connections and count >= self.client_connections and self._limited(client):
+                self._reject(client, "other", "connections", 1)
+                return False
+            self.connections[client] = count + 1
+            return True
+    
+    def disconnect(self, client):
+        """Затворена връзка от client"""
+        with self.lock:
+            count = self.connections.pop(client, 0) - 1
+            if count > 0:
+                self.connections[client] = count
+    
+    def _limited(self, client):
+        """Важат ли лимитите по адрес за client"""
+        return self.limit_loopback or not is_loopback(client)
+    
+    def _reject(self, client, endpoint, reason, retry_after):
+        """Отчети отхвърлена заявка (извиква се под self.lock)"""
+        key = (endpoint if endpoint in METRIC_ENDPOINTS else "other", reason)
+        self.rejected[key] += 1
+        self.reject_log.record(client, reason)
+        return reason, retry_after
+    
+    def render(self, lines):
+        """Броячите за /metrics"""
+        lines += ["# HELP pwm_http_rejected_total HTTP requests rejected by admission control",
+                  "# TYPE pwm_http_rejected_total counter"]
+        for (endpoint, reason), count in list(self.rejected.items()):
+            lines.append(f'pwm_http_rejected_total{{endpoint="{endpoint}",reason="{reason}"}} {count}')
+        lines += ["# HELP pwm_http_inflight_requests HTTP requests being processed",
+                  "# TYPE pwm_http_inflight_requests gauge",
+                  f"pwm_http_inflight_requests {self.inflight}",
+                  "# HELP pwm_http_streams Open /stream and /events connections",
+                  "# TYPE pwm_http_streams gauge",
+                  f"pwm_http_streams {self.streams}"]
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP сървър с ограничен брой работни нишки и плавно спиране
+    
+    Работна нишка се заема само докато се обслужва заявка. Keep-alive връзка
+    без следваща заявка се паркира в selector на отделна нишка и се
+    връща в работна нишка, щом клиентът изпрати данни; паркирана по-дълго от
+    PWMRequestHandler.timeout се затваря. Когато всички нишки са заети,
+    accept() изчаква и новите връзки остават в backlog на сокета.
+    Клиент с повече от admission.client_connections връзки получава 429 още
+    при accept(), без да заема нишка.
+    """
+    
+    def __init__(self, server_address, handler_class, workers=8):
+        super().__init__(server_address, handler_class)
+        self.workers = workers
+        self.admission = None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pwm-http")
+        self.slots = threading.BoundedSemaphore(workers)
+        # stopping: shutdown() е извикан; draining: текущите връзки се довършват
+        self.stopping = False
+        self.draining = False
+        self.connections = {}  # {socket: idle}
+        self.connections_cond = threading.Condition()
+        # Паркираните keep-alive връзки: нишката на selector-а ги взима от parking
+        self.parking = []
+        self.parking_lock = threading.Lock()
+        # Паркирани връзки с данни, които чакат свободна работна нишка (само за нишката на selector-а)
+        self.ready = deque()
+        self.wake_r, self.wake_w = socket.socketpair()
+        threading.Thread(target=self._idle_loop, name="pwm-http-idle", daemon=True).start()
+    
+    def process_request(self, request, client_address):
+        """Предай връзката на свободна работна нишка"""
+        if self.admission and not self.admission.connect(client_address[0]):
+            try:
+                request.sendall(REJECT_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        with self.connections_cond:
+            self.connections[request] = False
+        self._dispatch(request, client_address)
+    
+    def _dispatch(self, request, client_address, handler=None):
+        """Изчакай свободна работна нишка и ѝ дай връзката (handler: паркирана връзка)"""
+        while not self.slots.acquire(timeout=0.5):
+            if self.stopping or self.draining:
+                self._close(request, client_address, handler)
+                return
+        self.executor.submit(self._process_request_worker, request, client_address, handler)
+    
+    def finish_request(self, request, client_address):
+        """Обслужи връзката; връща handler-а, за да може връзката да се паркира"""
+        return self.RequestHandlerClass(request, client_address, self)
+    
+    def _process_request_worker(self, request, client_address, handler=None):
+        """Обслужи връзката в работна нишка, докато не се затвори или паркира"""
+        try:
+            if handler is None:
+                handler = self.finish_request(request, client_address)
+            else:
+                try:
+                    handler.serve_keepalive()
+                finally:
+                    handler.finish()
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            # Паркира се чак след края на обслужването: от тук нататък handler-ът
+            # може веднага да бъде взет от друга работна нишка
+            if handler is not None and handler.parked:
+                self._park(handler)
+            else:
+                self._close(request, client_address)
+            self.slots.release()
+            if self.ready:
+                self.wake_w.send(b"\0")
+    
+    def _close(self, request, client_address, handler=None):
+        """Затвори връзката и я махни от броячите"""
+        if handler is not None:
+            handler.parked = False
+            handler.finish()
+        self.shutdown_request(request)
+        with self.connections_cond:
+            self.connections.pop(request, None)
+            self.connections_cond.notify_all()
+        if self.admission:
+            self.admission.disconnect(client_address[0])
+    
+    def can_park(self):
+        """Може ли keep-alive връзка без следваща заявка да се паркира (не и докато сървърът спира)"""
+        return not (self.stopping or self.draining)
+    
+    def _park(self, handler):
+        """Предай паркираната връзка на selector-а"""
+        self.mark_idle(handler.connection, True)
+        with self.parking_lock:
+            self.parking.append(handler)
+        self.wake_w.send(b"\0")
+    
+    def _idle_loop(self):
+        """Следи паркираните връзки: при данни ги връща в работна нишка, след timeout ги затваря
+        
+        Нишката не чака свободна работна нишка: при заети нишки връзката с данни
+        остава в self.ready и се предава, щом някоя нишка се освободи и събуди
+        selector-а. Междувременно останалите връзки се следят и затварят.
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.wake_r, selectors.EVENT_READ)
+        ready = self.ready
+        while True:
+            for key, _ in selector.select(timeout=1.0):
+                if key.fileobj is self.wake_r:
+                    self.wake_r.recv(4096)
+                    continue
+                selector.unregister(key.fileobj)
+                ready.append(key.data[0])
+            
+            while ready:
+                handler = ready[0]
+                if self.stopping or self.draining:
+                    self._close(handler.connection, handler.client_address, handler)
+                elif self.slots.acquire(blocking=False):
+                    self.executor.submit(self._process_request_worker, handler.connection,
+                                         handler.client_address, handler)
+                else:
+                    break
+                ready.popleft()
+            
+            now = time.monotonic()
+            with self.parking_lock:
+                parking, self.parking = self.parking, []
+            for handler in parking:
+                selector.register(handler.connection, selectors.EVENT_READ, (handler, now))
+            for key in list(selector.get_map().values()):
+                if key.data and now - key.data[1] > key.data[0].timeout:
+                    selector.unregister(key.fileobj)
+                    handler = key.data[0]
+                    self._close(handler.connection, handler.client_address, handler)
+    
+    def shutdown(self):
+        """Спри serve_forever(), без да чакаш свободна работна нишка за чакаща връзка"""
+        self.stopping = True
+        super().shutdown()
+    
+    def mark_idle(self, request, idle):
+        """Отбележи дали връзката чака следваща заявка"""
+        with self.connections_cond:
+            if request in self.connections:
+                self.connections[request] = idle
+    
+    def drain(self, timeout=5.0):
+        """Изчакай текущите заявки и затвори неактивните keep-alive връзки"""
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        with self.connections_cond:
+            for request, idle in self.connections.items():
+                if idle:
+                    try:
+                        request.shutdown(socket.SHUT_RD)
+                    except OSError:
+                        pass
+            while self.connections:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"{len(self.connections)} връзки не завършиха навреме")
+                    break
+                self.connections_cond.wait(remaining)
+        self.executor.shutdown(wait=False)
+
+
+class BinaryRequestHandler(socketserver.BaseRequestHandler):
+    """Обработка на бинарния протокол по Unix socket
+    
+    Клиентът може да изпрати няколко frame-а наведнъж; отговорите се връщат
+    в същия ред с един sendall().
+    """
+    
+    def handle(self):
+        """Чети frame-ове до затваряне на връзката"""
+        controller = self.server.pwm_controller
+        size = BINARY_FRAME.size
+        pending = b""
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            pending += data
+            count = len(pending) // size
+            if not count:
+                continue
+            replies = bytearray()
+            for offset in range(0, count * size, size):
+                opcode, pin, _, value, seq = BINARY_FRAME.unpack_from(pending, offset)
+                status, value = self._execute(controller, opcode, pin, value)
+                replies += BINARY_FRAME.pack(opcode, pin, status, value, seq)
+            pending = pending[count * size:]
+            self.request.sendall(replies)
+    
+    @staticmethod
+    def _execute(controller, opcode, pin, value):
+        """Изпълни една команда; връща (status, value)"""
+        if opcode == OP_DUTY:
+            success = controller.set_duty_cycle(pin, value)
+        elif opcode == OP_ENABLE:
+            success = controller.enable_pwm(pin)
+        elif opcode == OP_DISABLE:
+            success = controller.disable_pwm(pin)
+        elif opcode == OP_INIT:
+            success = controller.initialize_pwm(pin, int(value) if value > 0 else None)
+        elif opcode == OP_STATUS:
+            status = controller.get_status(pin)
+            if not status:
+                return STATUS_FAILED, 0.0
+            return STATUS_OK, float(status["duty_cycle"])
+        elif opcode == OP_PING:
+            success = True
+        else:
+            return STATUS_BAD_REQUEST, 0.0
+        return (STATUS_OK if success else STATUS_FAILED), value
+
+
+class BinaryUnixServer(socketserver.ThreadingUnixStreamServer):
+    """Unix socket сървър за бинарния протокол (по една нишка на връзка)"""
+    
+    daemon_threads = True
+    
+    def __init__(self, socket_path, pwm_controller, mode=0o660):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, BinaryRequestHandler)
+        os.chmod(socket_path, mode)
+        self.socket_path = socket_path
+        self.pwm_controller = pwm_controller
+    
+    def server_close(self):
+        """Затвори сокета и изтрий файла"""
+        super().server_close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+def ws_apply_mask(payload, mask):
+    """XOR на payload с 4-байтовата маска (цялото съобщение наведнъж)"""
+    if not payload:
+        return payload
+    key = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    value = int.from_bytes(payload, "little") ^ int.from_bytes(key, "little")
+    return value.to_bytes(len(payload), "little")
+
+
+def ws_encode_frame(opcode, payload):
+    """WebSocket frame от сървъра (без маска)"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def ws_read_frame(rfile):
+    """Прочети един frame; връща (opcode, payload) или None при затворена връзка"""
+    header = rfile.read(2)
+    if len(header) < 2:
+        return None
+    opcode = header[0] & 0x0F
+    masked = header[1] & 0x80
+    length = header[1] & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", rfile.read(8))[0]
+    if length > STREAM_MAX_PAYLOAD:
+        raise ValueError(f"WebSocket frame too large: {length}")
+    mask = rfile.read(4) if masked else None
+    payload = rfile.read(length)
+    if len(payload) < length:
+        return None
+    if mask:
+        payload = ws_apply_mask(payload, mask)
+    return opcode, payload
+
+
+class SetpointStream:
+    """Еднопосочен поток от duty setpoints по WebSocket
+    
+    Setpoints се прилагат без отговор за всяко съобщение. Отделна нишка
+    изпраща периодично ack (text frame с JSON) с последния приложен seq,
+    броя приложени и отхвърлени setpoints и най-бавното прилагане.
+    """
+    
+    def __init__(self, handler, pins, ack_interval):
+        self.handler = handler
+        self.controller = handler.server.pwm_controller
+        self.pins = pins  # None = всички инициализирани пинове
+        self.ack_interval = ack_interval
+        self.write_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.last_seq = 0
+        self.received = 0
+        self.applied = 0
+        self.dropped = 0
+        self.max_apply_us = 0
+    
+    def send(self, opcode, payload):
+        """Изпрати frame (от четящата или от ack нишката)"""
+        with self.write_lock:
+            self.handler.wfile.write(ws_encode_frame(opcode, payload))
+    
+    def send_ack(self):
+        """Изпрати статистика"""
+        ack = {
+            "type": "ack",
+            "seq": self.last_seq,
+            "received": self.received,
+            "applied": self.applied,
+            "dropped": self.dropped,
+            "max_apply_us": self.max_apply_us
+        }
+        self.max_apply_us = 0
+        self.send(WS_OP_TEXT, json.dumps(ack).encode())
+    
+    def _ack_loop(self):
+        """Периодични ack-ове; при спиране на daemon затваря потока"""
+        sent_for = None
+        while not self.closed.wait(self.ack_interval):
+            if getattr(self.handler.server, "draining", False):
+                try:
+                    self.send(WS_OP_CLOSE, struct.pack("!H", 1001))
+                    self.handler.connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+                return
+            if sent_for != self.received:
+                sent_for = self.received
+                try:
+                    self.send_ack()
+                except OSError:
+                    return
+    
+    def apply(self, payload):
+        """Приложи всички setpoints от едно binary съобщение"""
+        size = STREAM_SETPOINT.size
+        for offset in range(0, len(payload) - size + 1, size):
+            seq, pin, duty_cycle = STREAM_SETPOINT.unpack_from(payload, offset)
+            self.received += 1
+            self.last_seq = seq
+            if self.pins is not None and pin not in self.pins:
+                self.dropped += 1
+                continue
+            start = time.perf_counter()
+            if self.controller.set_duty_cycle(pin, duty_cycle):
+                self.applied += 1
+            else:
+                self.dropped += 1
+            elapsed_us = int((time.perf_counter() - start) * 1e6)
+            if elapsed_us > self.max_apply_us:
+                self.max_apply_us = elapsed_us
+    
+    def run(self):
+        """Чети frame-ове до close frame или затворена връзка"""
+        ack_thread = threading.Thread(target=self._ack_loop, name="pwm-stream-ack", daemon=True)
+        ack_thread.start()
+        try:
+            while True:
+                frame = ws_read_frame(self.handler.rfile)
+                if frame is None:
+                    break
+                opcode, payload = frame
+                if opcode == WS_OP_BINARY:
+                    self.apply(payload)
+                elif opcode == WS_OP_PING:
+                    self.send(WS_OP_PONG, payload)
+                elif opcode == WS_OP_CLOSE:
+                    self.send_ack()
+                    self.send(WS_OP_CLOSE, payload[:2])
+                    break
+                elif opcode == WS_OP_TEXT:
+                    self.dropped += 1
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Stream от {self.handler.address_string()} прекъснат: {e}")
+        finally:
+            self.closed.set()
+            self.handler.close_connection = True
+        logger.info(f"Stream от {self.handler.address_string()} затворен: "
+                    f"{self.applied} приложени, {self.dropped} отхвърлени")
 
 
 class PWMRequestHandler(BaseHTTPRequestHandler):
     """HTTP Request Handler за PWM API"""
     
+    protocol_version = "HTTP/1.1"
+    # Headers и body се пишат отделно; без TCP_NODELAY keep-alive отговорите
+    # чакат delayed ACK (~40ms)
+    disable_nagle_algorithm = True
+    # Време за изчакване на следваща заявка по keep-alive връзка
+    timeout = 30
+    
+    def handle(self):
+        """Обслужи първата заявка и следващите по keep-alive връзката"""
+        self.parked = False
+        self.close_connection = True
+        self.handle_one_request()
+        self.serve_keepalive()
+    
+    def serve_keepalive(self):
+        """Следващите заявки по връзката, докато клиентът има изпратени данни
+        
+        Иначе връзката се паркира в PooledHTTPServer и работната нишка се
+        освобождава; сървърът извиква serve_keepalive() отново при нови данни.
+        """
+        self.parked = False
+        pooled = isinstance(self.server, PooledHTTPServer)
+        while not self.close_connection:
+            if pooled and not self._request_pending():
+                if self.close_connection:
+                    return  # клиентът е прекъснал връзката
+                if self.server.can_park():
+                    self.parked = True
+                    return
+            self.handle_one_request()
+    
+    def _request_pending(self):
+        """Има ли данни за следваща заявка; изчаква ги най-много KEEPALIVE_GRACE
+        
+        Клиент, който праща заявките една след друга, остава в същата нишка,
+        без прехвърляне през selector-а. При прекъсната от клиента връзка
+        задава close_connection и връща False.
+        """
+        self.connection.setblocking(False)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except ConnectionResetError:
+            self.close_connection = True
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+        poller = select.poll()
+        poller.register(self.connection, select.POLLIN)
+        return bool(poller.poll(KEEPALIVE_GRACE * 1000))
+    
+    def finish(self):
+        """Паркираната връзка остава отворена"""
+        if not self.parked:
+            super().finish()
+    
+    def handle_one_request(self):
+        """Обработи една заявка; между заявките връзката се води неактивна"""
+        if isinstance(self.server, PooledHTTPServer):
+            self.server.mark_idle(self.connection, True)
+        self.request_start = None
+        self.status_code = 0
+        self.admitted = False
+        self.streaming = False
+        try:
+            super().handle_one_request()
+        finally:
+            if self.admitted:
+                self.server.admission.release(self.streaming)
+        if self.request_start is not None:
+            self.server.pwm_controller.metrics.observe_request(
+                self._metric_endpoint(), time.perf_counter() - self.request_start, self.status_code)
+    
+    def parse_request(self):
+        """Връзката е активна от момента, в който е получен request line"""
+        self.request_start = time.perf_counter()
+        if isinstance(self.server, PooledHTTPServer):
+            self.server.mark_idle(self.connection, False)
+        return super().parse_request() and self._admit()
+    
+    def _admit(self):
+        """Admission control преди обработката; при отказ - 429 с Retry-After"""
+        admission = getattr(self.server, "admission", None)
+        if admission is None:
+            return True
+        endpoint = self._metric_endpoint()
+        self.streaming = endpoint in STREAMING_ENDPOINTS
+        reason, retry_after = admission.admit(self.client_address[0], endpoint, self.streaming)
+        if reason is None:
+            self.admitted = True
+            return True
+        
+        # Тялото на отхвърлената заявка се изчита, за да остане keep-alive връзката използваема
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = -1
+        if 0 <= content_length <= STREAM_MAX_PAYLOAD:
+            self.rfile.read(content_length)
+        else:
+            self.close_connection = True
+        body = json.dumps({"status": "error", "message": "Too many requests", "reason": reason}).encode()
+        self._send_response(429, body, 'application/json', {'Retry-After': str(math.ceil(retry_after))})
+        return False
+    
+    def send_response(self, code, message=None):
+        """Запомни статус кода за /metrics"""
+        self.status_code = code
+        super().send_response(code, message)
+    
+    def _metric_endpoint(self):
+        """Етикет на endpoint-а за /metrics (без query и номер на пин)"""
+        path = urlparse(getattr(self, 'path', '')).path
+        if path.startswith('/status/'):
+            return '/status/{pin}'
+        if path.startswith('/pins/'):
+            return '/pins/{pin}'
+        return path
+    
     def _send_json_response(self, status_code, data):
         """Изпрати JSON отговор"""
+        self._send_response(status_code, json.dumps(data).encode(), 'application/json')
+    
+    def _send_response(self, status_code, body, content_type, headers=None):
+        """Изпрати отговор с Content-Length (нужен за keep-alive)
+        
+        При 304 се изпращат само headers, без тяло.
+        """
         self.send_response(status_code)
-        self.send_header('Content-Type', 'application/json')
+        if status_code != 304:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
         self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if getattr(self.server, "draining", False):
+            self.send_header('Connection', 'close')
+            self.close_connection = True
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        if status_code != 304:
+            self.wfile.write(body)
+    
+    def _send_status(self, gpio_pin, query):
+        """Отговор на /status и /status/{pin} с ETag и ?fields="""
+        fields = None
+        if 'fields' in query:
+            fields = tuple(sorted({field for field in query['fields'][0].split(',') if field})) or None
+        
+        controller = self.server.pwm_controller
+        version, body = controller.encoded_status(gpio_pin, fields)
+        if body is None:
+            self._send_json_response(404, {"status": "error", "message": "PWM not initialized"})
+            return
+        
+        etag = f'"{controller.boot_id}-{version}"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if_none_match = self.headers.get('If-None-Match', '')
+        if etag in (tag.strip() for tag in if_none_match.split(',')) or if_none_match.strip() == '*':
+            self._send_response(304, b'', None, headers)
+        else:
+            self._send_response(200, body, 'application/json', headers)
     
     def do_GET(self):
         """Handle GET requests"""
@@ -193,46 +2320,212 @@ class PWMRequestHandler(BaseHTTPRequestHandler):
         
         if parsed.path == '/status':
             # Статус на всички PWM
-            status = self.server.pwm_controller.get_status()
-            self._send_json_response(200, {"status": "ok", "pwm": status})
+            self._send_status(None, parse_qs(parsed.query))
         
         elif parsed.path.startswith('/status/'):
             # Статус на конкретен GPIO
             try:
                 gpio_pin = int(parsed.path.split('/')[-1])
-                status = self.server.pwm_controller.get_status(gpio_pin)
-                if status:
-                    self._send_json_response(200, {"status": "ok", "pwm": status})
-                else:
-                    self._send_json_response(404, {"status": "error", "message": "PWM not initialized"})
             except ValueError:
                 self._send_json_response(400, {"status": "error", "message": "Invalid GPIO pin"})
+                return
+            self._send_status(gpio_pin, parse_qs(parsed.query))
+        
+        elif parsed.path == '/metrics':
+            # Prometheus метрики
+            connections = len(getattr(self.server, "connections", ()))
+            body = self.server.pwm_controller.metrics.render(self.server.pwm_controller, connections,
+                                                             getattr(self.server, "admission", None))
+            self._send_response(200, body.encode(), 'text/plain; version=0.0.4; charset=utf-8')
+        
+        elif parsed.path == '/topology':
+            # PWM чипове и съответствие GPIO -> (chip, channel)
+            topology = self.server.pwm_controller.topology.as_dict()
+            self._send_json_response(200, {"status": "ok", "topology": topology})
+        
+        elif parsed.path == '/loglevel':
+            # Текущо ниво на логване
+            level = logging.getLevelName(logging.getLogger().level)
+            self._send_json_response(200, {"status": "ok", "level": level})
+        
+        elif parsed.path == '/stream':
+            self._handle_stream(parse_qs(parsed.query))
+        
+        elif parsed.path == '/events':
+            self._handle_events(parse_qs(parsed.query))
         
         else:
             self._send_json_response(404, {"status": "error", "message": "Not found"})
     
-    def do_POST(self):
-        """Handle POST requests"""
-        parsed = urlparse(self.path)
+    def _handle_events(self, query):
+        """Server-sent events с промените по пиновете
+        
+        Всяко събитие има id "{boot_id}-{n}"; клиентът възобновява с
+        Last-Event-ID. Ако id-то е от друго стартиране на daemon или
+        пропуснатите събития вече не се пазят, първо се изпраща snapshot.
+        """
+        try:
+            pins = None
+            if 'pins' in query:
+                pins = {int(pin) for pin in query['pins'][0].split(',') if pin}
+        except ValueError:
+            self._send_json_response(400, {"status": "error", "message": "Invalid pins"})
+            return
+        
+        controller = self.server.pwm_controller
+        last_event_id = self.headers.get('Last-Event-ID') or query.get('last_event_id', [None])[0]
+        boot_id, _, number = (last_event_id or "").rpartition("-")
+        last_event_id = int(number) if boot_id == controller.boot_id and number.isdigit() else None
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        
+        last_write = time.monotonic()
+        try:
+            # Кратко чакане, за да се забележи спиране на daemon
+            while not getattr(self.server, "draining", False):
+                events, snapshot = controller.wait_events(last_event_id, 1.0)
+                if snapshot:
+                    last_event_id, status = snapshot
+                    if pins is not None:
+                        status = {pin: value for pin, value in status.items() if pin in pins}
+                    self.wfile.write(f"id: {controller.boot_id}-{last_event_id}\nevent: snapshot\n"
+                                     f"data: {json.dumps(status)}\n\n".encode())
+                    last_write = time.monotonic()
+                    continue
+                
+                chunks = []
+                for event_id, delta in events:
+                    last_event_id = event_id
+                    if pins is None or delta["gpio_pin"] in pins:
+                        chunks.append(f"id: {controller.boot_id}-{event_id}\nevent: delta\n"
+                                      f"data: {json.dumps(delta)}\n\n")
+                if not chunks and time.monotonic() - last_write >= EVENT_KEEPALIVE:
+                    chunks.append(": keepalive\n\n")
+                if chunks:
+                    self.wfile.write("".join(chunks).encode())
+                    last_write = time.monotonic()
+        except OSError:
+            pass
+    
+    def _handle_stream(self, query):
+        """WebSocket handshake и поток от setpoints"""
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            self._send_json_response(400, {"status": "error", "message": "WebSocket upgrade required"})
+            return
+        
+        try:
+            pins = None
+            if 'pins' in query:
+                pins = {int(pin) for pin in query['pins'][0].split(',') if pin}
+            ack_interval = float(query.get('ack_ms', ['1000'])[0]) / 1000
+        except ValueError:
+            self._send_json_response(400, {"status": "error", "message": "Invalid pins or ack_ms"})
+            return
+        
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        
+        logger.info(f"Stream от {self.address_string()} за пинове {sorted(pins) if pins else 'всички'}")
+        SetpointStream(self, pins, max(ack_interval, 0.05)).run()
+    
+    def _read_json(self):
+        """JSON обект от тялото на заявката; None (и 400) при невалиден JSON"""
         content_length = int(self.headers.get('Content-Length', 0))
         body = self.rfile.read(content_length).decode() if content_length > 0 else '{}'
         
         try:
             data = json.loads(body)
         except json.JSONDecodeError:
+            data = None
+        if not isinstance(data, dict):
             self._send_json_response(400, {"status": "error", "message": "Invalid JSON"})
+            return None
+        return data
+    
+    def do_PUT(self):
+        """Handle PUT requests"""
+        parsed = urlparse(self.path)
+        data = self._read_json()
+        if data is None:
+            return
+        
+        if parsed.path.startswith('/pins/'):
+            # Желано състояние на пин: записва се само разликата
+            try:
+                gpio_pin = int(parsed.path.split('/')[-1])
+            except ValueError:
+                self._send_json_response(400, {"status": "error", "message": "Invalid GPIO pin"})
+                return
+            self._put_pin(gpio_pin, data)
+        
+        else:
+            self._send_json_response(404, {"status": "error", "message": "Not found"})
+    
+    def _put_pin(self, gpio_pin, data):
+        """PUT /pins/{gpio}: {"frequency", "duty_cycle", "enabled", "max_rate_hz"} (липсващите не се променят)"""
+        frequency = data.get('frequency')
+        duty_cycle = data.get('duty_cycle')
+        enabled = data.get('enabled')
+        max_rate_hz = data.get('max_rate_hz')
+        
+        if frequency is not None and (not is_number(frequency) or frequency <= 0):
+            self._send_json_response(400, {"status": "error", "message": "Invalid frequency"})
+            return
+        if duty_cycle is not None and not is_number(duty_cycle):
+            self._send_json_response(400, {"status": "error", "message": "Invalid duty_cycle"})
+            return
+        if enabled is not None and not isinstance(enabled, bool):
+            self._send_json_response(400, {"status": "error", "message": "enabled must be true or false"})
+            return
+        if max_rate_hz is not None and (not is_number(max_rate_hz) or max_rate_hz < 0):
+            self._send_json_response(400, {"status": "error", "message": "Invalid max_rate_hz"})
+            return
+        
+        controller = self.server.pwm_controller
+        if frequency is None and gpio_pin not in controller.pwm_instances:
+            self._send_json_response(400, {"status": "error", "message": "frequency required for an uninitialized pin"})
+            return
+        
+        success, writes = controller.apply_state(gpio_pin, frequency, duty_cycle, enabled, max_rate_hz)
+        if success:
+            self._send_json_response(200, {
+                "status": "ok",
+                "gpio_pin": gpio_pin,
+                "writes": [{"attr": attr, "value": value} for attr, value in writes],
+                "pwm": controller.get_status().get(gpio_pin, {})
+            })
+        else:
+            self._send_json_response(500, {"status": "error", "message": "Failed to apply state"})
+    
+    def do_POST(self):
+        """Handle POST requests"""
+        parsed = urlparse(self.path)
+        data = self._read_json()
+        if data is None:
             return
         
         if parsed.path == '/init':
             # Инициализация на PWM
             gpio_pin = data.get('gpio_pin')
-            frequency = data.get('frequency', 26000)
+            frequency = data.get('frequency')
+            max_rate_hz = data.get('max_rate_hz')
             
             if gpio_pin is None:
                 self._send_json_response(400, {"status": "error", "message": "gpio_pin required"})
                 return
             
-            success = self.server.pwm_controller.initialize_pwm(gpio_pin, frequency)
+            success = self.server.pwm_controller.initialize_pwm(gpio_pin, frequency, max_rate_hz)
             if success:
                 self._send_json_response(200, {"status": "ok", "message": "PWM initialized"})
             else:
@@ -281,52 +2574,279 @@ class PWMRequestHandler(BaseHTTPRequestHandler):
             else:
                 self._send_json_response(500, {"status": "error", "message": "Failed to disable PWM"})
         
+        elif parsed.path == '/fade':
+            # Плавен преход на duty cycle
+            gpio_pin = data.get('gpio_pin')
+            duty_cycle = data.get('duty_cycle')
+            duration = data.get('duration', 1.0)
+            curve = data.get('curve', 'linear')
+            
+            if gpio_pin is None or duty_cycle is None:
+                self._send_json_response(400, {"status": "error", "message": "gpio_pin and duty_cycle required"})
+                return
+            if curve not in FADE_CURVES:
+                self._send_json_response(400, {"status": "error", "message": f"curve must be one of {list(FADE_CURVES)}"})
+                return
+            if not is_number(duty_cycle):
+                self._send_json_response(400, {"status": "error", "message": "Invalid duty_cycle"})
+                return
+            if not is_number(duration) or duration < 0:
+                self._send_json_response(400, {"status": "error", "message": "Invalid duration"})
+                return
+            
+            success = self.server.pwm_controller.fade_duty_cycle(gpio_pin, duty_cycle, duration, curve)
+            if success:
+                self._send_json_response(200, {"status": "ok", "message": "Fade started"})
+            else:
+                self._send_json_response(500, {"status": "error", "message": "Failed to start fade"})
+        
+        elif parsed.path == '/batch':
+            # Няколко операции върху един или няколко пина
+            operations = data.get('operations')
+            atomic = bool(data.get('atomic', False))
+            
+            if not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations):
+                self._send_json_response(400, {"status": "error", "message": "operations list required"})
+                return
+            
+            success, results = self.server.pwm_controller.execute_batch(operations, atomic)
+            if success:
+                self._send_json_response(200, {"status": "ok", "results": results})
+            else:
+                self._send_json_response(500, {"status": "error", "message": "Batch failed", "results": results})
+        
+        elif parsed.path == '/rescan':
+            # Повторно сканиране на PWM чиповете
+            topology = self.server.pwm_controller.topology
+            topology.scan()
+            self._send_json_response(200, {"status": "ok", "topology": topology.as_dict()})
+        
+        elif parsed.path == '/unexport':
+            # Освобождаване на PWM канала
+            gpio_pin = data.get('gpio_pin')
+            
+            if gpio_pin is None:
+                self._send_json_response(400, {"status": "error", "message": "gpio_pin required"})
+                return
+            
+            success = self.server.pwm_controller.unexport_pwm(gpio_pin)
+            if success:
+                self._send_json_response(200, {"status": "ok", "message": "PWM unexported"})
+            else:
+                self._send_json_response(500, {"status": "error", "message": "Failed to unexport PWM"})
+        
+        elif parsed.path == '/loglevel':
+            # Смяна на нивото на логване без рестарт
+            level = str(data.get('level', '')).upper()
+            
+            if level not in LOG_LEVELS:
+                self._send_json_response(400, {"status": "error",
+                                               "message": f"level must be one of {', '.join(LOG_LEVELS)}"})
+                return
+            
+            root = logging.getLogger()
+            previous = logging.getLevelName(root.level)
+            root.setLevel(level)
+            logger.warning(f"Ниво на логване: {previous} -> {level}")
+            self._send_json_response(200, {"status": "ok", "level": level, "previous": previous})
+        
         else:
             self._send_json_response(404, {"status": "error", "message": "Not found"})
     
+    def log_request(self, code='-', size='-'):
+        """Успешните и отхвърлените заявки се логват на DEBUG (броят им е в /metrics), останалите на INFO"""
+        level = logging.DEBUG if isinstance(code, int) and (code < 400 or code == 429) else logging.INFO
+        if logger.isEnabledFor(level):
+            logger.log(level, f'{self.address_string()} - "{self.requestline}" {code} {size}')
+    
     def log_message(self, format, *args):
         """Логване на HTTP заявки"""
         logger.info(f"{self.address_string()} - {format % args}")
 
 
+def parse_args():
+    """Аргументи от командния ред"""
+    parser = argparse.ArgumentParser(description="PWM Daemon за Raspberry Pi 5")
+    parser.add_argument("--host", default="0.0.0.0", help="Адрес за слушане")
+    parser.add_argument("--port", type=int, default=9000, help="TCP порт")
+    parser.add_argument("--sysfs-root", default=PWM_SYSFS_ROOT,
+                        help="Корен на PWM sysfs (за тестове: фалшиво дърво)")
+    parser.add_argument("--backend", choices=["sysfs", "mmap"], default="sysfs",
+                        help="sysfs: ядрото (/sys/class/pwm); mmap: директен запис в регистрите на PWM контролера")
+    parser.add_argument("--mmap-path", default=MMAP_DEFAULT_PATH,
+                        help="Файл с регистровия блок за --backend mmap (за тестове: обикновен файл)")
+    parser.add_argument("--mmap-offset", type=lambda v: int(v, 0), default=MMAP_DEFAULT_OFFSET,
+                        help="Отместване на регистровия блок във файла (по подразбиране RP1 PWM0)")
+    parser.add_argument("--mmap-clock-hz", type=int, default=MMAP_DEFAULT_CLOCK_HZ,
+                        help="Тактова честота на PWM контролера за --backend mmap")
+    parser.add_argument("--mmap-channels", type=int, default=MMAP_DEFAULT_CHANNELS,
+                        help="Брой канали в регистровия блок")
+    parser.add_argument("--fade-tick-hz", type=float, default=100,
+                        help="Честота на стъпките при /fade")
+    parser.add_argument("--max-duty-rate", type=float, default=0,
+                        help="Най-много записа на duty cycle в секунда за канал (0 = без обединяване)")
+    parser.add_argument("--pin-map", type=parse_pin_map, default=None,
+                        help='GPIO -> PWM канал, напр. "12=pwmchip0:0,13=pwmchip0:1" (chip е по избор)')
+    parser.add_argument("--export-timeout", type=float, default=1.0,
+                        help="Максимално изчакване (s) на канала след export")
+    parser.add_argument("--state-journal", default="/var/lib/pwm-daemon/state.jsonl",
+                        help="Журнал на състоянието за възстановяване след рестарт (празно = изключен)")
+    parser.add_argument("--unix-socket", default="/run/pwm-daemon.sock",
+                        help="Път на Unix socket за бинарния протокол (празно = изключен)")
+    parser.add_argument("--server-mode", choices=["threaded", "single"], default="threaded",
+                        help="threaded: пул от нишки с HTTP/1.1 keep-alive; single: една нишка, HTTP/1.0")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Максимален брой едновременно обслужвани връзки")
+    parser.add_argument("--keepalive-timeout", type=float, default=30,
+                        help="Секунди за изчакване на следваща заявка по keep-alive връзка")
+    parser.add_argument("--drain-timeout", type=float, default=5,
+                        help="Секунди за довършване на текущите заявки при спиране")
+    parser.add_argument("--client-rate", type=float, default=ADMISSION_CLIENT_RATE,
+                        help="Заявки в секунда на клиентски адрес (0 = без лимит)")
+    parser.add_argument("--client-burst", type=float, default=ADMISSION_CLIENT_BURST,
+                        help="Допустим пик над --client-rate")
+    parser.add_argument("--client-connections", type=int, default=ADMISSION_CLIENT_CONNECTIONS,
+                        help="Най-много едновременни връзки на клиентски адрес (0 = без лимит)")
+    parser.add_argument("--limit-loopback", action="store_true",
+                        help="Прилагай --client-rate и --client-connections и за локалните клиенти")
+    parser.add_argument("--endpoint-limit", type=parse_endpoint_limit, action="append", default=[],
+                        metavar="ENDPOINT=RATE[:BURST]",
+                        help="Общ лимит за endpoint, напр. /status=50:100 (може да се повтаря)")
+    parser.add_argument("--control-reserve", type=int, default=ADMISSION_CONTROL_RESERVE,
+                        help="Работни нишки, запазени за /duty, /enable, /disable и др.")
+    parser.add_argument("--max-streams", type=int, default=None,
+                        help="Най-много едновременни /stream и /events връзки (по подразбиране workers/2)")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO",
+                        help="Ниво на логване (може да се смени с POST /loglevel)")
+    parser.add_argument("--log-summary-interval", type=float, default=LOG_SUMMARY_INTERVAL,
+                        help="Секунди между обобщените редове за промените на duty cycle")
+    return parser.parse_args()
+
+
 def main():
     """Main entry point"""
-    HOST = '0.0.0.0'
-    PORT = 9000
+    args = parse_args()
+    HOST = args.host
+    PORT = args.port
+    logging.getLogger().setLevel(args.log_level)
     
     logger.info("=" * 60)
     logger.info("PWM Daemon за Raspberry Pi 5")
     logger.info("Hardware PWM HTTP REST API")
     logger.info("=" * 60)
     
-    # Провери дали има root права
-    if os.geteuid() != 0:
+    # Провери дали има root права (не е нужно за фалшиво sysfs дърво или регистров файл)
+    if args.backend == "sysfs":
+        needs_root = args.sysfs_root == PWM_SYSFS_ROOT
+    else:
+        needs_root = args.mmap_path == MMAP_DEFAULT_PATH
+    if needs_root and os.geteuid() != 0:
         logger.error("Daemon трябва да се стартира с root права!")
         logger.error("Използвай: sudo python3 pwm_daemon.py")
         sys.exit(1)
     
+    # От тук нататък записите се извеждат от фонова нишка
+    log_listener = start_async_logging()
+    
+    # Журнал на състоянието
+    journal = None
+    if args.state_journal:
+        try:
+            os.makedirs(os.path.dirname(args.state_journal) or ".", exist_ok=True)
+            journal = StateJournal(args.state_journal)
+        except OSError as e:
+            logger.warning(f"Журналът {args.state_journal} не е наличен: {e}")
+    
+    # PWM backend
+    if args.backend == "mmap":
+        try:
+            backend = MmapBackend(args.mmap_path, args.mmap_offset, args.mmap_clock_hz, args.mmap_channels)
+        except (OSError, ValueError) as e:
+            logger.error(f"Регистровият блок {args.mmap_path}@{args.mmap_offset:#x} не е достъпен: {e}")
+            log_listener.stop()
+            sys.exit(1)
+    else:
+        backend = SysfsBackend(args.sysfs_root, args.export_timeout)
+    logger.info(f"PWM backend: {backend.name}")
+    
     # Създай PWM контролер
-    pwm_controller = PWMController()
+    pwm_controller = PWMController(fade_tick_hz=args.fade_tick_hz, max_rate_hz=args.max_duty_rate,
+                                   pin_map=args.pin_map, journal=journal,
+                                   log_summary_interval=args.log_summary_interval, backend=backend)
+    pwm_controller.restore_state()
     
     # Създай HTTP сървър
-    server = HTTPServer((HOST, PORT), PWMRequestHandler)
+    if args.server_mode == "threaded":
+        PWMRequestHandler.timeout = args.keepalive_timeout
+        server = PooledHTTPServer((HOST, PORT), PWMRequestHandler, workers=args.workers)
+    else:
+        PWMRequestHandler.protocol_version = "HTTP/1.0"
+        server = HTTPServer((HOST, PORT), PWMRequestHandler)
     server.pwm_controller = pwm_controller
     
-    logger.info(f"✓ PWM Daemon стартиран на {HOST}:{PORT}")
+    # Admission control: лимити по клиент и endpoint, приоритет на управлението
+    max_inflight = args.workers if args.server_mode == "threaded" else 1
+    server.admission = AdmissionControl(max_inflight, client_rate=args.client_rate,
+                                        client_burst=args.client_burst,
+                                        endpoint_limits=dict(args.endpoint_limit),
+                                        control_reserve=args.control_reserve,
+                                        client_connections=args.client_connections,
+                                        max_streams=args.max_streams,
+                                        limit_loopback=args.limit_loopback)
+    
+    # Unix socket с бинарен протокол за локални клиенти
+    binary_server = None
+    if args.unix_socket:
+        try:
+            binary_server = BinaryUnixServer(args.unix_socket, pwm_controller)
+            threading.Thread(target=binary_server.serve_forever, name="pwm-unix", daemon=True).start()
+            logger.info(f"✓ Бинарен протокол на unix:{args.unix_socket}")
+        except OSError as e:
+            logger.warning(f"Unix socket {args.unix_socket} не е наличен: {e}")
+    
+    # SIGTERM (systemctl stop) спира приемането на нови връзки;
+    # shutdown() трябва да се извика от друга нишка
+    def handle_sigterm(sig, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    
+    logger.info(f"✓ PWM Daemon стартиран на {HOST}:{PORT} ({args.server_mode})")
     logger.info("API endpoints:")
     logger.info("  POST /init        - Инициализация на PWM")
     logger.info("  POST /duty        - Настройка на duty cycle")
     logger.info("  POST /enable      - Включване на PWM")
     logger.info("  POST /disable     - Изключване на PWM")
+    logger.info("  POST /unexport    - Освобождаване на PWM канал")
+    logger.info("  POST /rescan      - Повторно сканиране на PWM чиповете")
+    logger.info("  POST /fade        - Плавен преход на duty cycle")
+    logger.info("  POST /batch       - Няколко операции в една заявка")
+    logger.info("  PUT  /pins/{pin}  - Желано състояние на пин (само разликата)")
     logger.info("  GET  /status      - Статус на всички PWM")
     logger.info("  GET  /status/{pin} - Статус на конкретен GPIO")
+    logger.info("  GET  /topology    - PWM чипове и GPIO съответствия")
+    logger.info("  GET  /metrics     - Prometheus метрики")
+    logger.info("  GET  /stream      - WebSocket поток от setpoints")
+    logger.info("  GET  /events      - Server-sent events с промените")
+    logger.info("  POST /loglevel    - Смяна на нивото на логване")
     logger.info("-" * 60)
     
     try:
         server.serve_forever()
     except KeyboardInterrupt:
-        logger.info("\nSpиране на daemon...")
-        server.shutdown()
+        pass
+    
+    logger.info("Спиране на daemon...")
+    if binary_server:
+        binary_server.shutdown()
+        binary_server.server_close()
+    if isinstance(server, PooledHTTPServer):
+        server.drain(args.drain_timeout)
+    server.server_close()
+    if journal:
+        journal.close()
+    backend.close()
+    log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -7,10 +7,19 @@ import os
 import sys
 import json
 import logging
+import logging.handlers
+import queue
+import random
 import time
 import signal
-import urllib.request
-import urllib.error
+import base64
+import hashlib
+import socket
+import struct
+import threading
+import http.client
+import ctypes
+from concurrent.futures import ThreadPoolExecutor, wait
 
 logging.basicConfig(
     level=logging.INFO,
@@ -18,43 +27,775 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+OPTIONS_PATH = "/data/options.json"
+# inotify: файлът е записан и затворен или преместен на мястото си
+INOTIFY_CLOSE_WRITE = 0x00000008
+INOTIFY_MOVED_TO = 0x00000080
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len (следва името)
+# Опции за връзката с daemon; промяна на някоя от тях създава нов клиент
+CONNECTION_OPTIONS = ("daemon_host", "daemon_port", "daemons")
+
+# Интервал (s) на обобщените редове за често повтарящи се събития (duty cycle)
+LOG_SUMMARY_INTERVAL = 10
+
+
+def start_async_logging():
+    """Премести handler-ите на root logger-а зад опашка с фонова нишка за писане
+    
+    Връща QueueListener-а (спира се с .stop() при изход).
+    """
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+
+class RateLimitedLog:
+    """Ограничено логване на често повтарящо се събитие по ключ (напр. пин)
+    
+    Първото събитие след тих интервал се логва веднага, следващите само се
+    броят и се извеждат като един обобщен ред на interval секунди.
+    """
+    
+    def __init__(self, logger, message, summary, interval=LOG_SUMMARY_INTERVAL, level=logging.INFO):
+        self.logger = logger
+        self.message = message
+        self.summary = summary
+        self.interval = interval
+        self.level = level
+        self.entries = {}  # {key: [брой, monotonic на последния ред, последна стойност]}
+        self.lock = threading.Lock()
+        self.thread = None
+    
+    def record(self, key, value):
+        """Отчети събитие за key с последна стойност value"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] or now - entry[1] < self.interval):
+                entry[0] += 1
+                entry[2] = value
+                return
+            self.entries[key] = [0, now, value]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="pwm-log-summary", daemon=True)
+                self.thread.start()
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, self.message.format(key=key, value=value))
+    
+    def _run(self):
+        """Извеждай обобщените редове"""
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            with self.lock:
+                ready = [(key, entry[0], entry[2]) for key, entry in self.entries.items() if entry[0]]
+                for key, count, value in ready:
+                    self.entries[key] = [0, now, value]
+            if self.logger.isEnabledFor(self.level):
+                for key, count, value in ready:
+                    self.logger.log(self.level, self.summary.format(
+                        key=key, value=value, count=count, interval=self.interval))
+
+
+# Грешки, при които keep-alive връзката е била затворена от daemon
+# (напр. след рестарт) и заявката може да се повтори по нова връзка
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+
+# Краен срок (s) по подразбиране за една операция, вкл. повторенията
+DEFAULT_DEADLINE = 3.0
+# Най-много опита за една операция, вкл. първия
+RETRY_ATTEMPTS = 3
+# Пауза преди повторение: случайна между 0 и min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2^опит)
+RETRY_BASE_DELAY = 0.05
+RETRY_MAX_DELAY = 0.5
+# Заявки, които дават същия резултат при повторение (GET и PUT също се повтарят)
+IDEMPOTENT_ENDPOINTS = ("/init", "/duty", "/enable", "/disable", "/batch")
+
+# Circuit breaker: след BREAKER_FAILURES поредни неуспешни опита заявките
+# се отказват веднага, а фонова нишка проверява daemon с нарастващ интервал
+BREAKER_FAILURES = 3
+BREAKER_PROBE_INTERVAL = 0.5
+BREAKER_PROBE_MAX_INTERVAL = 10
+# Повторения на възстановяването на желаното състояние, ако се промени междувременно
+REPLAY_ATTEMPTS = 3
+# Краен срок за прилагане на каналите на един daemon: до 2 последователни
+# операции на пин (disable и unexport при премахване); пиновете са паралелни
+APPLY_DEADLINE = 2 * DEFAULT_DEADLINE
+
+
+class DaemonUnavailable(ConnectionError):
+    """Circuit breaker-ът е отворен - daemon не отговаря"""
+
+
+class DaemonBusy(Exception):
+    """Daemon отхвърли заявката с 429 (admission control); retry_after е в секунди"""
+    
+    def __init__(self, retry_after):
+        super().__init__(f"pwm-daemon is busy, retry after {retry_after:g}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Отказва заявките веднага, докато daemon не отговаря
+    
+    След failures поредни неуспеха breaker-ът се отваря и фонова нишка
+    извиква probe() с нарастващ интервал. Щом probe() върне True,
+    breaker-ът се затваря и се извиква on_recover().
+    """
+    
+    def __init__(self, probe, on_recover=None, failures=BREAKER_FAILURES,
+                 interval=BREAKER_PROBE_INTERVAL, max_interval=BREAKER_PROBE_MAX_INTERVAL):
+        self.probe = probe
+        self.on_recover = on_recover
+        self.failures = failures
+        self.interval = interval
+        self.max_interval = max_interval
+        self.count = 0
+        self.is_open = False
+        self.closed = threading.Event()
+        self.lock = threading.Lock()
+    
+    def allow(self):
+        """Може ли да се изпрати заявка"""
+        return not self.is_open
+    
+    def success(self):
+        """Успешен опит"""
+        self.count = 0
+    
+    def failure(self, error):
+        """Неуспешен опит (грешка във връзката)"""
+        with self.lock:
+            self.count += 1
+            if self.is_open or self.count < self.failures:
+                return
+            self.is_open = True
+        logger.warning(f"pwm-daemon is not responding ({error}); failing fast until it recovers")
+        threading.Thread(target=self._run, name="pwm-breaker", daemon=True).start()
+    
+    def close(self):
+        """Спри фоновата проверка"""
+        self.closed.set()
+    
+    def _run(self):
+        """Проверявай daemon, докато отговори"""
+        delay = self.interval
+        while not self.closed.wait(delay):
+            try:
+                recovered = self.probe()
+            except (OSError, http.client.HTTPException):
+                recovered = False
+            if recovered:
+                with self.lock:
+                    self.is_open = False
+                    self.count = 0
+                logger.info("✓ pwm-daemon is reachable again")
+                if self.on_recover:
+                    self.on_recover()
+                return
+            delay = min(delay * 2, self.max_interval)
+
+
+# Бинарен протокол на pwm-daemon по Unix socket (виж pwm_daemon.py):
+# <opcode:u8> <pin:u8> <status:u16> <value:f32> <seq:u32>
+BINARY_FRAME = struct.Struct("<BBHfI")
+OP_PING = 0
+DEFAULT_SOCKET_PATH = "/run/pwm-daemon.sock"
+
+# HTTP endpoint -> (opcode, поле със стойността)
+BINARY_ENDPOINTS = {
+    "/init": (1, "frequency"),
+    "/duty": (2, "duty_cycle"),
+    "/enable": (3, None),
+    "/disable": (4, None),
+}
+
+
+class BinaryTransport:
+    """Persistent връзка към pwm-daemon по Unix socket с бинарни frame-ове"""
+    
+    def __init__(self, socket_path, timeout=5):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+        self.seq = 0
+        self.lock = threading.Lock()
+    
+    def _connect(self, timeout):
+        """Отвори връзката"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+    
+    def close(self):
+        """Затвори връзката"""
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+    
+    def _recv_frame(self):
+        """Прочети точно един frame"""
+        buf = bytearray(BINARY_FRAME.size)
+        view = memoryview(buf)
+        received = 0
+        while received < len(buf):
+            n = self.sock.recv_into(view[received:])
+            if not n:
+                raise ConnectionResetError("pwm-daemon closed the socket")
+            received += n
+        return BINARY_FRAME.unpack(buf)
+    
+    def call(self, opcode, pin, value=0.0, timeout=None):
+        """Изпрати команда и върни (status, value); при прекъсната връзка опитай още веднъж"""
+        timeout = self.timeout if timeout is None else timeout
+        with self.lock:
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+            frame = BINARY_FRAME.pack(opcode, pin, 0, value, self.seq)
+            for attempt in range(2):
+                reused = self.sock is not None
+                try:
+                    if reused:
+                        self.sock.settimeout(timeout)
+                    else:
+                        self._connect(timeout)
+                    self.sock.sendall(frame)
+                    _, _, status, value, seq = self._recv_frame()
+                    if seq != self.seq:
+                        raise ConnectionError(f"Sequence mismatch: sent {self.seq}, got {seq}")
+                    return status, value
+                except OSError:
+                    if self.sock is not None:
+                        self.sock.close()
+                        self.sock = None
+                    if attempt or not reused:
+                        raise
+
+
+# Грешки при свързване към Unix socket-а, след които transport="auto" минава изцяло на HTTP
+UNIX_CONNECT_ERRORS = (FileNotFoundError, ConnectionRefusedError, PermissionError)
+
+
+# WebSocket поток за setpoints (GET /stream на pwm-daemon)
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_OP_TEXT = 0x1
+WS_OP_BINARY = 0x2
+WS_OP_CLOSE = 0x8
+WS_OP_PING = 0x9
+STREAM_SETPOINT = struct.Struct("<IBf")
+
+# GET /events: daemon изпраща keep-alive на 15 s, така че 60 s без данни
+# означава прекъсната връзка
+EVENTS_TIMEOUT = 60
+EVENTS_MAX_RETRY_DELAY = 30
+
+
+class PWMStream:
+    """Еднопосочен поток от duty setpoints към pwm-daemon по WebSocket
+    
+    send() не чака отговор. Daemon изпраща периодично ack; последният е в
+    self.stats заедно с lag (изпратени, но все още непотвърдени setpoints).
+    """
+    
+    def __init__(self, host, port, pins=None, ack_interval=1.0, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.seq = 0
+        self.write_lock = threading.Lock()
+        self.closed = False
+        self.stats = {"sent": 0, "seq": 0, "lag": 0, "received": 0, "applied": 0, "dropped": 0}
+        
+        query = f"ack_ms={int(ack_interval * 1000)}"
+        if pins:
+            query += "&pins=" + ",".join(str(pin) for pin in pins)
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = (f"GET /stream?{query} HTTP/1.1\r\n"
+                   f"Host: {host}:{port}\r\n"
+                   "Upgrade: websocket\r\n"
+                   "Connection: Upgrade\r\n"
+                   f"Sec-WebSocket-Key: {key}\r\n"
+                   "Sec-WebSocket-Version: 13\r\n\r\n")
+        self.sock.sendall(request.encode())
+        
+        self.rfile = self.sock.makefile("rb")
+        status_line = self.rfile.readline(65537).decode("iso-8859-1")
+        headers = http.client.parse_headers(self.rfile)
+        expected = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        if " 101 " not in status_line or headers.get("Sec-WebSocket-Accept") != expected:
+            self.sock.close()
+            raise ConnectionError(f"WebSocket handshake failed: {status_line.strip()}")
+        
+        # Сървърът изпраща само ack-ове; без timeout при четене
+        self.sock.settimeout(None)
+        self.reader = threading.Thread(target=self._read_acks, name="pwm-stream", daemon=True)
+        self.reader.start()
+    
+    def _send_frame(self, opcode, payload):
+        """Изпрати маскиран frame (клиентските frame-ове винаги са маскирани)"""
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 0x80 | 127, length)
+        if payload:
+            key = (mask * (length // 4 + 1))[:length]
+            value = int.from_bytes(payload, "little") ^ int.from_bytes(key, "little")
+            payload = value.to_bytes(length, "little")
+        with self.write_lock:
+            self.sock.sendall(header + mask + payload)
+    
+    def send_many(self, setpoints):
+        """Изпрати няколко (gpio_pin, duty_cycle) в едно съобщение"""
+        payload = bytearray()
+        for gpio_pin, duty_cycle in setpoints:
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+            payload += STREAM_SETPOINT.pack(self.seq, gpio_pin, duty_cycle)
+        self._send_frame(WS_OP_BINARY, bytes(payload))
+        self.stats["sent"] += len(setpoints)
+    
+    def send(self, gpio_pin, duty_cycle):
+        """Изпрати един setpoint"""
+        self.send_many([(gpio_pin, duty_cycle)])
+    
+    def _read_acks(self):
+        """Чети ack-овете от daemon"""
+        try:
+            while True:
+                header = self.rfile.read(2)
+                if len(header) < 2:
+                    break
+                opcode = header[0] & 0x0F
+                length = header[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", self.rfile.read(8))[0]
+                payload = self.rfile.read(length)
+                if opcode == WS_OP_TEXT:
+                    ack = json.loads(payload.decode())
+                    stats = dict(self.stats)
+                    stats.update({k: ack[k] for k in ("seq", "received", "applied", "dropped") if k in ack})
+                    stats["lag"] = (self.seq - ack.get("seq", 0)) & 0xFFFFFFFF
+                    self.stats = stats
+                elif opcode == WS_OP_CLOSE:
+                    break
+        except (OSError, ValueError) as e:
+            if not self.closed:
+                logger.warning(f"Stream closed: {e}")
+        finally:
+            self.closed = True
+    
+    def close(self):
+        """Затвори потока (daemon изпраща последен ack преди close)"""
+        if not self.closed:
+            try:
+                self._send_frame(WS_OP_CLOSE, struct.pack("!H", 1000))
+                self.reader.join(timeout=2)
+            except OSError:
+                pass
+        self.closed = True
+        self.sock.close()
+
+
+class ConnectionPool:
+    """Пул от persistent HTTP/1.1 връзки към pwm-daemon"""
+    
+    def __init__(self, host, port, size=4, timeout=5):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+    
+    def _acquire(self, timeout=None):
+        """Вземи свободна връзка или създай нова (timeout за тази заявка, по подразбиране self.timeout)"""
+        timeout = self.timeout if timeout is None else timeout
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+    
+    def _release(self, conn):
+        """Върни връзката в пула"""
+        with self.lock:
+            if conn.sock is not None and len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+    
+    def close(self):
+        """Затвори всички свободни връзки"""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+    
+    @staticmethod
+    def _encode_body(data):
+        """Сериализирай JSON тялото на заявка"""
+        return json.dumps(data, separators=(',', ':')).encode() if data else b'{}'
+    
+    def request(self, method, endpoint, data=None, headers=None, timeout=None):
+        """Изпрати заявка и върни (status, body, response headers)"""
+        body = self._encode_body(data) if method != "GET" else None
+        headers = dict(headers or {})
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        
+        for attempt in range(2):
+            conn = self._acquire(timeout)
+            reused = conn.sock is not None
+            try:
+                conn.request(method, endpoint, body=body, headers=headers)
+                response = conn.getresponse()
+                payload = response.read()
+            except STALE_CONNECTION_ERRORS:
+                conn.close()
+                if attempt or not reused:
+                    raise
+                continue
+            except Exception:
+                conn.close()
+                raise
+            self._release(conn)
+            return response.status, payload, response.headers
+    
+    def pipeline(self, requests):
+        """Изпрати няколко заявки наведнъж по една връзка и прочети отговорите по ред
+        
+        requests: [(method, endpoint, data)]. Връща [(status, body)].
+        """
+        raw = b"".join(self._encode_request(method, endpoint, data)
+                       for method, endpoint, data in requests)
+        
+        for attempt in range(2):
+            conn = self._acquire()
+            reused = conn.sock is not None
+            results = []
+            try:
+                if not reused:
+                    conn.connect()
+                conn.sock.sendall(raw)
+                with conn.sock.makefile("rb") as fp:
+                    for _ in requests:
+                        results.append(self._read_response(fp))
+                        if results[-1][2]:
+                            break
+            except STALE_CONNECTION_ERRORS:
+                conn.close()
+                if attempt or not reused or results:
+                    raise
+                continue
+            except Exception:
+                conn.close()
+                raise
+            
+            if results[-1][2]:
+                conn.close()
+                if len(results) < len(requests):
+                    # daemon затвори връзката по средата на pipeline-а
+                    raise http.client.RemoteDisconnected(
+                        f"Connection closed after {len(results)} of {len(requests)} responses")
+            self._release(conn)
+            return [(status, payload) for status, payload, _ in results]
+    
+    def _encode_request(self, method, endpoint, data):
+        """Сериализирай една HTTP/1.1 заявка за pipeline"""
+        lines = [f"{method} {endpoint} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        body = b""
+        if method != "GET":
+            body = self._encode_body(data)
+            lines.append("Content-Type: application/json")
+            lines.append(f"Content-Length: {len(body)}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+    
+    @staticmethod
+    def _read_response(fp):
+        """Прочети един отговор от буферирания поток; връща (status, body, close)"""
+        status_line = fp.readline(65537)
+        if not status_line:
+            raise http.client.RemoteDisconnected("Remote end closed connection without response")
+        try:
+            version, status, _ = status_line.decode("iso-8859-1").split(None, 2)
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+        headers = http.client.parse_headers(fp)
+        length = int(headers.get("Content-Length", 0))
+        payload = fp.read(length) if length else b""
+        close = headers.get("Connection", "").lower() == "close" or version == "HTTP/1.0"
+        return status, payload, close
+
 
 class PWMClient:
     """HTTP клиент за pwm-daemon"""
     
-    def __init__(self, host="127.0.0.1", port=9000):
+    def __init__(self, host="127.0.0.1", port=9000, transport="http", socket_path=DEFAULT_SOCKET_PATH,
+                 workers=4, deadline=DEFAULT_DEADLINE):
+        """transport: "http", "unix" (бинарен протокол) или "auto" (unix ако сокетът съществува)
+        
+        workers: брой операции за различни пинове, изпълнявани паралелно (виж map_pins).
+        deadline: краен срок (s) по подразбиране за една операция, вкл. повторенията;
+        всеки метод приема и собствен deadline.
+        """
         self.host = host
         self.port = port
         self.base_url = f"http://{host}:{port}"
         self.gpio_pin = None
-        self.is_initialized = False
+        self.pins = set()
+        # Последният статус по пин за условни GET заявки: {gpio_pin: (etag, pwm)}
+        self.status_cache = {}
+        self.deadline = deadline
+        # Последното желано състояние по пин {gpio_pin: {"frequency", "duty_cycle", "enabled"}};
+        # изпраща се отново, когато daemon започне да отговаря след прекъсване
+        self.desired = {}
+        self.desired_lock = threading.Lock()
+        self.breaker = CircuitBreaker(self._probe, self._replay)
+        self.pool = ConnectionPool(host, port, size=workers)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pwm-client")
+        self.duty_log = RateLimitedLog(
+            logger, "✓ Duty cycle set to {value}% on GPIO{key}",
+            "✓ {count} duty updates on GPIO{key} in last {interval:g}s (last: {value}%)")
+        # До кога daemon е поискал пауза (Retry-After); дотогава неуспехите не са грешки
+        self.busy_until = 0
+        self.busy_log = RateLimitedLog(
+            logger, "pwm-daemon rejected {key} (429), retry after {value:g}s",
+            "pwm-daemon rejected {count} {key} requests in last {interval:g}s (429)",
+            level=logging.WARNING)
+        
+        self.transport = transport
+        self.binary = None
+        if transport == "unix" or (transport == "auto" and os.path.exists(socket_path)):
+            self.binary = BinaryTransport(socket_path)
+            logger.info(f"Using binary protocol on unix:{socket_path}")
+    
+    @property
+    def is_initialized(self):
+        """Има ли поне един инициализиран пин"""
+        return bool(self.pins)
+    
+    def close(self):
+        """Затвори връзките към daemon"""
+        self.breaker.close()
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+        if self.binary:
+            self.binary.close()
     
-    def _make_request(self, endpoint, method="GET", data=None):
-        """Направи HTTP заявка към daemon"""
-        url = f"{self.base_url}{endpoint}"
+    @staticmethod
+    def _binary_request(binary, endpoint, data, timeout=None):
+        """Изпрати команда по бинарния протокол; отговорът е във формата на HTTP API"""
+        opcode, field = BINARY_ENDPOINTS[endpoint]
+        value = float(data.get(field, 0)) if field else 0.0
+        status, _ = binary.call(opcode, data["gpio_pin"], value, timeout)
+        return {"status": "ok" if status == 0 else "error"}
+    
+    def _call(self, send, endpoint, method, deadline=None, fallback=False):
+        """Изпълни send(timeout) с краен срок, повторения и circuit breaker
         
-        try:
-            if method == "GET":
-                with urllib.request.urlopen(url, timeout=5) as response:
-                    return json.loads(response.read().decode())
+        Идемпотентните заявки се повтарят при грешка във връзката с
+        нарастваща случайна пауза - най-много RETRY_ATTEMPTS опита, докато
+        има време до крайния срок и breaker-ът е затворен. Всеки неуспешен
+        опит се отчита в breaker-а. Отхвърлена с 429 заявка (DaemonBusy) не е
+        обработена, затова се повтаря след Retry-After за всеки метод, ако
+        пауза се побира в крайния срок. timeout е оставащото време. Хвърля
+        DaemonUnavailable, ако breaker-ът е отворен, иначе последната грешка.
+        
+        fallback: заявката има резервен транспорт - грешка във връзката се
+        хвърля веднага, без повторения и без да се отчита в breaker-а.
+        """
+        if not self.breaker.allow():
+            raise DaemonUnavailable("pwm-daemon is not responding")
+        
+        deadline_at = time.monotonic() + (self.deadline if deadline is None else deadline)
+        retry = method in ("GET", "PUT") or endpoint in IDEMPOTENT_ENDPOINTS
+        attempt = 0
+        while True:
+            try:
+                result = send(max(deadline_at - time.monotonic(), 0.001))
+                self.breaker.success()
+                return result
+            except DaemonBusy as e:
+                self.breaker.success()
+                attempt += 1
+                self.busy_until = time.monotonic() + e.retry_after
+                if attempt >= RETRY_ATTEMPTS or self.busy_until >= deadline_at:
+                    raise
+                logger.debug(f"{method} {endpoint}: {e}")
+                time.sleep(e.retry_after)
+            except (OSError, http.client.HTTPException) as e:
+                if fallback:
+                    raise
+                self.breaker.failure(e)
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                attempt += 1
+                if (not retry or attempt >= RETRY_ATTEMPTS or not self.breaker.allow() or
+                        time.monotonic() + delay >= deadline_at):
+                    raise
+                logger.debug(f"{method} {endpoint} failed ({e}); retrying in {delay * 1000:.0f} ms")
+                time.sleep(delay)
+    
+    def _probe(self):
+        """Проверка от circuit breaker-а: отговаря ли daemon (и 429 е отговор)"""
+        if self.binary and self.transport == "unix":
+            return self.binary.call(OP_PING, 0, timeout=1)[0] == 0
+        return self.pool.request("GET", "/status", timeout=1)[0] in (200, 429)
+    
+    def _http_request(self, method, endpoint, data=None, headers=None, timeout=None):
+        """pool.request(), който при 429 хвърля DaemonBusy с паузата от Retry-After"""
+        status, payload, response_headers = self.pool.request(method, endpoint, data, headers, timeout)
+        if status == 429:
+            try:
+                retry_after = max(float(response_headers.get("Retry-After", 1)), 0)
+            except ValueError:
+                retry_after = 1
+            raise DaemonBusy(retry_after)
+        return status, payload, response_headers
+    
+    def _remember(self, op):
+        """Запомни желаното състояние от операция във формата на /batch"""
+        gpio_pin = op.get("gpio_pin")
+        with self.desired_lock:
+            state = self.desired.setdefault(gpio_pin, {})
+            if op["op"] == "init":
+                state["frequency"] = op.get("frequency", 26000)
+            elif op["op"] == "duty":
+                state["duty_cycle"] = op["duty_cycle"]
+            elif op["op"] in ("enable", "disable"):
+                state["enabled"] = op["op"] == "enable"
+    
+    def _replay(self):
+        """Изпрати отново желаното състояние след прекъсване на daemon"""
+        for _ in range(REPLAY_ATTEMPTS):
+            with self.desired_lock:
+                desired = {pin: dict(state) for pin, state in self.desired.items() if "frequency" in state}
+            if not desired:
+                return
             
-            elif method == "POST":
-                headers = {'Content-Type': 'application/json'}
-                json_data = json.dumps(data).encode() if data else b'{}'
-                req = urllib.request.Request(url, data=json_data, headers=headers, method='POST')
-                
-                with urllib.request.urlopen(req, timeout=5) as response:
-                    return json.loads(response.read().decode())
+            try:
+                results = self.map_pins(lambda pin: self.apply(desired[pin], pin) is not None, desired)
+            except RuntimeError:
+                return  # клиентът е затворен
+            logger.info(f"Replayed desired state: {', '.join(f'GPIO{pin}' + ('' if ok else ' (failed)') for pin, ok in sorted(results.items()))}")
+            
+            with self.desired_lock:
+                if all(self.desired.get(pin) == state for pin, state in desired.items()):
+                    return
+    
+    @staticmethod
+    def _decode(payload):
+        """Декодирай JSON отговор"""
+        return json.loads(payload.decode()) if payload else None
+    
+    def _make_request(self, endpoint, method="GET", data=None, deadline=None):
+        """Направи заявка към daemon (по Unix socket, ако е възможно, иначе HTTP)
         
-        except urllib.error.URLError as e:
+        deadline: краен срок (s) за заявката, вкл. повторенията (None = self.deadline).
+        """
+        binary = self.binary
+        if binary and endpoint in BINARY_ENDPOINTS:
+            fallback = self.transport != "unix"
+            try:
+                return self._call(lambda timeout: self._binary_request(binary, endpoint, data, timeout),
+                                  endpoint, method, deadline, fallback)
+            except DaemonUnavailable as e:
+                logger.debug(f"{endpoint}: {e}")
+                return None
+            except OSError as e:
+                if not fallback:
+                    logger.error(f"Connection error: {e}")
+                    return None
+                if isinstance(e, UNIX_CONNECT_ERRORS):
+                    # Сокетът не е достъпен: следващите заявки отиват директно по HTTP
+                    logger.warning(f"Unix socket {binary.socket_path} is unusable ({e}); using HTTP")
+                    self.binary = None
+                    binary.close()
+                else:
+                    logger.warning(f"Unix socket error, falling back to HTTP: {e}")
+        
+        try:
+            status, payload, _ = self._call(
+                lambda timeout: self._http_request(method, endpoint, data, timeout=timeout),
+                endpoint, method, deadline)
+            return self._decode(payload)
+        
+        except DaemonUnavailable as e:
+            logger.debug(f"{endpoint}: {e}")
+            return None
+        except DaemonBusy as e:
+            self.busy_log.record(endpoint, e.retry_after)
+            return None
+        except (OSError, http.client.HTTPException) as e:
             logger.error(f"Connection error: {e}")
             return None
         except Exception as e:
             logger.error(f"Request error: {e}")
             return None
     
+    def _log_failure(self, message):
+        """Грешка от операция; докато daemon не отговаря или е поискал пауза - само на DEBUG"""
+        if self.breaker.allow() and time.monotonic() >= self.busy_until:
+            logger.error(message)
+        else:
+            logger.debug(message)
+    
+    def _resolve_pin(self, gpio_pin):
+        """Пин за операцията (по подразбиране последният инициализиран) или None"""
+        pin = self.gpio_pin if gpio_pin is None else gpio_pin
+        return pin if pin in self.pins else None
+    
+    def map_pins(self, func, pins):
+        """Изпълни func(pin) паралелно за всеки пин; връща {pin: резултат}"""
+        futures = {pin: self.executor.submit(func, pin) for pin in pins}
+        return {pin: future.result() for pin, future in futures.items()}
+    
+    def pipeline(self, calls):
+        """Изпрати няколко заявки наведнъж (HTTP pipelining)
+        
+        calls: [(endpoint, method, data)]. Връща списък с отговори (или None при грешка).
+        """
+        try:
+            results = self.pool.pipeline([(method, endpoint, data) for endpoint, method, data in calls])
+            return [self._decode(payload) for _, payload in results]
+        
+        except (OSError, http.client.HTTPException) as e:
+            logger.error(f"Connection error: {e}")
+            return [None] * len(calls)
+        except Exception as e:
+            logger.error(f"Request error: {e}")
+            return [None] * len(calls)
+    
     def check_connection(self):
         """Провери връзка с daemon"""
+        if self.transport == "unix":
+            try:
+                if self.binary.call(OP_PING, 0)[0] == 0:
+                    logger.info(f"✓ Connected to pwm-daemon at unix:{self.binary.socket_path}")
+                    return True
+            except OSError as e:
+                logger.error(f"Connection error: {e}")
+            logger.error(f"✗ Cannot connect to pwm-daemon at unix:{self.binary.socket_path}")
+            return False
+        
         result = self._make_request("/status", "GET")
         if result and result.get("status") == "ok":
             logger.info(f"✓ Connected to pwm-daemon at {self.base_url}")
@@ -62,7 +803,7 @@ class PWMClient:
         logger.error(f"✗ Cannot connect to pwm-daemon at {self.base_url}")
         return False
     
-    def initialize_pwm(self, gpio_pin, frequency):
+    def initialize_pwm(self, gpio_pin, frequency, deadline=None):
         """Инициализира PWM"""
         logger.info(f"Initializing PWM on GPIO{gpio_pin} at {frequency}Hz...")
         
@@ -71,88 +812,422 @@ class PWMClient:
             "frequency": frequency
         }
         
-        result = self._make_request("/init", "POST", data)
+        self._remember({"op": "init", **data})
+        result = self._make_request("/init", "POST", data, deadline)
         if result and result.get("status") == "ok":
             self.gpio_pin = gpio_pin
-            self.is_initialized = True
+            self.pins.add(gpio_pin)
             logger.info(f"✓ PWM initialized: GPIO{gpio_pin}, {frequency}Hz")
             return True
         
-        logger.error("✗ Failed to initialize PWM")
+        self._log_failure("✗ Failed to initialize PWM")
         return False
     
-    def set_duty_cycle(self, duty_cycle):
+    def set_duty_cycle(self, duty_cycle, gpio_pin=None, deadline=None):
         """Настрой duty cycle"""
-        if not self.is_initialized:
+        gpio_pin = self._resolve_pin(gpio_pin)
+        if gpio_pin is None:
             logger.error("PWM not initialized")
             return False
         
         data = {
-            "gpio_pin": self.gpio_pin,
+            "gpio_pin": gpio_pin,
             "duty_cycle": duty_cycle
         }
         
-        result = self._make_request("/duty", "POST", data)
+        self._remember({"op": "duty", **data})
+        result = self._make_request("/duty", "POST", data, deadline)
+        if result and result.get("status") == "ok":
+            self.duty_log.record(gpio_pin, duty_cycle)
+            return True
+        
+        self._log_failure("✗ Failed to set duty cycle")
+        return False
+    
+    def fade(self, duty_cycle, duration, curve="linear", gpio_pin=None, deadline=None):
+        """Плавен преход до duty_cycle, изпълняван от daemon"""
+        gpio_pin = self._resolve_pin(gpio_pin)
+        if gpio_pin is None:
+            logger.error("PWM not initialized")
+            return False
+        
+        data = {
+            "gpio_pin": gpio_pin,
+            "duty_cycle": duty_cycle,
+            "duration": duration,
+            "curve": curve
+        }
+        
+        self._remember({"op": "duty", "gpio_pin": gpio_pin, "duty_cycle": duty_cycle})
+        result = self._make_request("/fade", "POST", data, deadline)
         if result and result.get("status") == "ok":
-            logger.info(f"✓ Duty cycle set to {duty_cycle}%")
+            logger.info(f"✓ Fading GPIO{gpio_pin} to {duty_cycle}% over {duration}s ({curve})")
             return True
         
-        logger.error("✗ Failed to set duty cycle")
+        self._log_failure("✗ Failed to start fade")
         return False
     
-    def enable_pwm(self):
+    def enable_pwm(self, gpio_pin=None, deadline=None):
         """Включи PWM"""
-        if not self.is_initialized:
+        gpio_pin = self._resolve_pin(gpio_pin)
+        if gpio_pin is None:
             logger.error("PWM not initialized")
             return False
         
-        data = {"gpio_pin": self.gpio_pin}
+        data = {"gpio_pin": gpio_pin}
         
-        result = self._make_request("/enable", "POST", data)
+        self._remember({"op": "enable", **data})
+        result = self._make_request("/enable", "POST", data, deadline)
         if result and result.get("status") == "ok":
-            logger.info("✓ PWM enabled")
+            logger.info(f"✓ PWM enabled on GPIO{gpio_pin}")
             return True
         
-        logger.error("✗ Failed to enable PWM")
+        self._log_failure("✗ Failed to enable PWM")
         return False
     
-    def disable_pwm(self):
+    def disable_pwm(self, gpio_pin=None, deadline=None):
         """Изключи PWM"""
-        if not self.is_initialized:
+        gpio_pin = self._resolve_pin(gpio_pin)
+        if gpio_pin is None:
             return False
         
-        data = {"gpio_pin": self.gpio_pin}
+        data = {"gpio_pin": gpio_pin}
         
-        result = self._make_request("/disable", "POST", data)
+        self._remember({"op": "disable", **data})
+        result = self._make_request("/disable", "POST", data, deadline)
         if result and result.get("status") == "ok":
-            logger.info("✓ PWM disabled")
+            logger.info(f"✓ PWM disabled on GPIO{gpio_pin}")
             return True
         
-        logger.error("✗ Failed to disable PWM")
+        self._log_failure("✗ Failed to disable PWM")
         return False
     
-    def get_status(self):
-        """Вземи статус"""
-        if not self.is_initialized:
+    def unexport_pwm(self, gpio_pin=None, deadline=None):
+        """Освободи PWM канала на daemon"""
+        gpio_pin = self._resolve_pin(gpio_pin)
+        if gpio_pin is None:
+            return False
+        
+        result = self._make_request("/unexport", "POST", {"gpio_pin": gpio_pin}, deadline)
+        if result and result.get("status") == "ok":
+            with self.desired_lock:
+                self.desired.pop(gpio_pin, None)
+            self.pins.discard(gpio_pin)
+            self.status_cache.pop(gpio_pin, None)
+            if self.gpio_pin == gpio_pin:
+                self.gpio_pin = None
+            logger.info(f"✓ PWM released on GPIO{gpio_pin}")
+            return True
+        
+        self._log_failure(f"✗ Failed to release GPIO{gpio_pin}")
+        return False
+    
+    def batch(self, operations, atomic=False, deadline=None):
+        """Изпълни няколко операции с една заявка към /batch
+        
+        operations: [{"op": "init"|"duty"|"enable"|"disable", "gpio_pin": ..., ...}].
+        Връща списък с резултат за всяка операция или None при грешка във връзката.
+        """
+        for op in operations:
+            self._remember(op)
+        result = self._make_request("/batch", "POST", {"operations": operations, "atomic": atomic}, deadline)
+        if result is None:
+            return None
+        return result.get("results", [])
+    
+    def apply(self, state, gpio_pin=None, deadline=None):
+        """Доведи пина до желаното състояние с една заявка PUT /pins/{gpio}
+        
+        state: {"frequency", "duty_cycle", "enabled", "max_rate_hz"}; липсващите
+        полета не се променят (frequency е задължителна за неинициализиран пин).
+        daemon записва само разликата, затова повторението е безопасно.
+        Връща извършените записи [{"attr", "value"}] или None при грешка.
+        """
+        gpio_pin = self.gpio_pin if gpio_pin is None else gpio_pin
+        if gpio_pin is None:
+            logger.error("gpio_pin required")
+            return None
+        
+        with self.desired_lock:
+            desired = self.desired.setdefault(gpio_pin, {})
+            desired.update({key: state[key] for key in ("frequency", "duty_cycle", "enabled") if key in state})
+        result = self._make_request(f"/pins/{gpio_pin}", "PUT", state, deadline)
+        if result and result.get("status") == "ok":
+            self.gpio_pin = gpio_pin
+            self.pins.add(gpio_pin)
+            writes = result.get("writes", [])
+            logger.info(f"✓ GPIO{gpio_pin}: {state} applied ({len(writes)} writes)")
+            return writes
+        
+        self._log_failure(f"✗ Failed to apply {state} on GPIO{gpio_pin}" +
+                          (f": {result.get('message')}" if result else ""))
+        return None
+    
+    def setup_pwm(self, gpio_pin, frequency, duty_cycle, enable=True, deadline=None):
+        """Инициализирай, настрой duty cycle и включи PWM с една заявка"""
+        logger.info(f"Setting up PWM on GPIO{gpio_pin} at {frequency}Hz, {duty_cycle}%...")
+        
+        operations = [
+            {"op": "init", "gpio_pin": gpio_pin, "frequency": frequency},
+            {"op": "duty", "gpio_pin": gpio_pin, "duty_cycle": duty_cycle},
+        ]
+        if enable:
+            operations.append({"op": "enable", "gpio_pin": gpio_pin})
+        
+        results = self.batch(operations, atomic=True, deadline=deadline)
+        if results and all(r.get("status") == "ok" for r in results):
+            self.gpio_pin = gpio_pin
+            self.pins.add(gpio_pin)
+            logger.info(f"✓ PWM ready: GPIO{gpio_pin}, {frequency}Hz, {duty_cycle}%")
+            return True
+        
+        for r in results or []:
+            if r.get("status") == "error":
+                self._log_failure(f"✗ GPIO{gpio_pin} {r.get('op')}: {r.get('message')}")
+        self._log_failure(f"✗ Failed to set up PWM on GPIO{gpio_pin}")
+        return False
+    
+    def open_stream(self, pins=None, ack_interval=1.0):
+        """Отвори поток за непрекъснато подаване на setpoints (виж PWMStream)"""
+        if pins is None and self.pins:
+            pins = sorted(self.pins)
+        return PWMStream(self.host, self.port, pins, ack_interval)
+    
+    def watch(self, pins=None, last_event_id=None, stop=None):
+        """Генератор на промените от GET /events (server-sent events)
+        
+        Връща (event, event_id, data): event е "snapshot" (пълен статус) или
+        "delta" (само променените полета на един пин). При прекъсване връзката
+        се възстановява с Last-Event-ID, докато stop (threading.Event) не е зададен.
+        """
+        path = "/events"
+        if pins:
+            path += "?pins=" + ",".join(str(pin) for pin in pins)
+        delay = 1
+        
+        while stop is None or not stop.is_set():
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=EVENTS_TIMEOUT)
+            try:
+                headers = {"Accept": "text/event-stream"}
+                if last_event_id is not None:
+                    headers["Last-Event-ID"] = str(last_event_id)
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                if response.status == 429:
+                    raise DaemonBusy(float(response.getheader("Retry-After", delay)))
+                if response.status != 200:
+                    raise http.client.HTTPException(f"GET /events returned {response.status}")
+                delay = 1
+                
+                event, event_id, data = "message", None, []
+                while stop is None or not stop.is_set():
+                    line = response.readline()
+                    if not line:
+                        raise http.client.RemoteDisconnected("Event stream closed")
+                    line = line.decode().rstrip("\r\n")
+                    if line:
+                        field, _, value = line.partition(":")
+                        value = value[1:] if value.startswith(" ") else value
+                        if field == "event":
+                            event = value
+                        elif field == "id":
+                            event_id = value
+                        elif field == "data":
+                            data.append(value)
+                        continue
+                    
+                    if data:
+                        last_event_id = event_id
+                        yield event, event_id, json.loads("\n".join(data))
+                    event, data = "message", []
+            
+            except (OSError, ValueError, http.client.HTTPException, DaemonBusy) as e:
+                if stop is not None and stop.is_set():
+                    break
+                # При 429 daemon казва кога да се опита отново
+                wait = e.retry_after if isinstance(e, DaemonBusy) else delay
+                logger.warning(f"Event stream error: {e}; reconnecting in {wait:g}s")
+                if stop is not None:
+                    stop.wait(wait)
+                else:
+                    time.sleep(wait)
+                delay = min(delay * 2, EVENTS_MAX_RETRY_DELAY)
+            finally:
+                conn.close()
+    
+    def get_status(self, gpio_pin=None, deadline=None):
+        """Вземи статус
+        
+        Заявката е условна (If-None-Match): ако статусът не се е променил, daemon
+        отговаря с 304 без тяло и се връща запазеният резултат.
+        """
+        gpio_pin = self._resolve_pin(gpio_pin)
+        if gpio_pin is None:
+            return {}
+        
+        etag, cached = self.status_cache.get(gpio_pin, (None, {}))
+        endpoint = f"/status/{gpio_pin}"
+        try:
+            status, payload, headers = self._call(
+                lambda timeout: self._http_request("GET", endpoint, timeout=timeout,
+                                                   headers={"If-None-Match": etag} if etag else None),
+                endpoint, "GET", deadline)
+            if status == 304:
+                return cached
+            result = self._decode(payload)
+        
+        except DaemonUnavailable as e:
+            logger.debug(f"{endpoint}: {e}")
+            return {}
+        except DaemonBusy as e:
+            self.busy_log.record(endpoint, e.retry_after)
+            return cached
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            logger.error(f"Connection error: {e}")
             return {}
         
-        result = self._make_request(f"/status/{self.gpio_pin}", "GET")
         if result and result.get("status") == "ok":
-            return result.get("pwm", {})
+            pwm = result.get("pwm", {})
+            if headers.get("ETag"):
+                self.status_cache[gpio_pin] = (headers["ETag"], pwm)
+            return pwm
         
+        self.status_cache.pop(gpio_pin, None)
         return {}
 
 
-def load_options():
+class PWMFleet:
+    """Няколко pwm-daemon-а, управлявани паралелно - по един PWMClient на daemon
+    
+    Всяка операция се изпраща до всички daemon-и едновременно с общ краен
+    срок, така че промяна на целия флот струва около един round-trip, а не N.
+    Резултатът е {"ok", "elapsed_ms", "hosts": {име: {"ok", "result", "error", "elapsed_ms"}}}.
+    """
+    
+    def __init__(self, daemons, workers=4, deadline=DEFAULT_DEADLINE):
+        """daemons: [{"host", "port", "name", "transport", "socket_path"}] (виж fleet_daemons)
+        
+        Името по подразбиране е "host:port". workers е за паралелните пинове на един daemon.
+        """
+        self.deadline = deadline
+        self.clients = {}
+        for daemon in daemons:
+            port = daemon.get("port", 9000)
+            name = daemon.get("name") or f"{daemon['host']}:{port}"
+            self.clients[name] = PWMClient(host=daemon["host"], port=port,
+                                           transport=daemon.get("transport", "http"),
+                                           socket_path=daemon.get("socket_path", DEFAULT_SOCKET_PATH),
+                                           workers=workers, deadline=deadline)
+        # Двойно повече нишки: закъсняла заявка от предишна операция не бави следващата
+        self.executor = ThreadPoolExecutor(max_workers=max(2, 2 * len(self.clients)),
+                                           thread_name_prefix="pwm-fleet")
+    
+    def close(self):
+        """Затвори връзките към всички daemon-и"""
+        self.executor.shutdown(wait=True)
+        for client in self.clients.values():
+            client.close()
+    
+    def run(self, func, hosts=None, deadline=None, ok=bool):
+        """Изпълни func(client, remaining) паралелно за всеки daemon
+        
+        func може да е и {име: func} - различна операция за всеки daemon.
+        hosts: само тези daemon-и (None = всички). remaining е оставащото време
+        до общия краен срок; daemon, който не е отговорил до него, е с
+        "error": "deadline exceeded". ok(резултат) решава дали операцията е успешна.
+        """
+        calls = func if isinstance(func, dict) else dict.fromkeys(self.clients if hosts is None else hosts, func)
+        unknown = set(calls) - set(self.clients)
+        if unknown:
+            raise ValueError(f"Unknown daemons: {', '.join(sorted(unknown))}")
+        
+        started = time.monotonic()
+        deadline_at = started + (self.deadline if deadline is None else deadline)
+        
+        def call(name, func):
+            call_started = time.monotonic()
+            try:
+                result = func(self.clients[name], max(deadline_at - call_started, 0.001))
+                entry = {"ok": bool(ok(result)), "result": result, "error": None}
+            except Exception as e:
+                entry = {"ok": False, "result": None, "error": str(e)}
+            entry["elapsed_ms"] = round((time.monotonic() - call_started) * 1000, 2)
+            return entry
+        
+        futures = {name: self.executor.submit(call, name, func) for name, func in calls.items()}
+        wait(futures.values(), timeout=max(deadline_at - time.monotonic(), 0))
+        elapsed_ms = round((time.monotonic() - started) * 1000, 2)
+        results = {}
+        for name, future in futures.items():
+            if future.done():
+                results[name] = future.result()
+            else:
+                results[name] = {"ok": False, "result": None, "error": "deadline exceeded", "elapsed_ms": elapsed_ms}
+        
+        failed = [name for name, entry in results.items() if not entry["ok"]]
+        logger.debug(f"Fleet: {len(results)} daemons in {elapsed_ms} ms"
+                     + (f", failed: {', '.join(failed)}" if failed else ""))
+        return {"ok": not failed, "elapsed_ms": elapsed_ms, "hosts": results}
+    
+    @staticmethod
+    def _per_host(value, names):
+        """Стойност за всеки daemon: value е обща или {име: стойност}"""
+        return value if isinstance(value, dict) else dict.fromkeys(names, value)
+    
+    def check_connection(self):
+        """Провери връзката с всеки daemon"""
+        return self.run(lambda client, remaining: client.check_connection())
+    
+    def batch(self, operations, atomic=False, deadline=None):
+        """Една заявка към /batch на всеки daemon
+        
+        operations: списък (еднакъв за всички) или {име: списък} за различни
+        операции по daemon. Успешен е daemon, за който всички операции са "ok".
+        """
+        operations = self._per_host(operations, self.clients)
+        return self.run({name: (lambda client, remaining, ops=ops: client.batch(ops, atomic, remaining))
+                         for name, ops in operations.items()},
+                        deadline=deadline,
+                        ok=lambda results: results is not None and all(r.get("status") == "ok" for r in results))
+    
+    def setup_pwm(self, gpio_pin, frequency, duty_cycle, enable=True, deadline=None):
+        """setup_pwm на всеки daemon; duty_cycle може да е {име: duty cycle}"""
+        duty_cycles = self._per_host(duty_cycle, self.clients)
+        return self.run({name: (lambda client, remaining, duty=duty:
+                                client.setup_pwm(gpio_pin, frequency, duty, enable, remaining))
+                         for name, duty in duty_cycles.items()}, deadline=deadline)
+    
+    def set_duty_cycle(self, duty_cycle, gpio_pin=None, deadline=None):
+        """Duty cycle на всеки daemon; duty_cycle може да е {име: duty cycle}"""
+        duty_cycles = self._per_host(duty_cycle, self.clients)
+        return self.run({name: (lambda client, remaining, duty=duty: client.set_duty_cycle(duty, gpio_pin, remaining))
+                         for name, duty in duty_cycles.items()}, deadline=deadline)
+    
+    def enable_pwm(self, gpio_pin=None, hosts=None, deadline=None):
+        """Включи PWM на всички (или избрани) daemon-и"""
+        return self.run(lambda client, remaining: client.enable_pwm(gpio_pin, remaining), hosts, deadline)
+    
+    def disable_pwm(self, gpio_pin=None, hosts=None, deadline=None):
+        """Изключи PWM на всички (или избрани) daemon-и"""
+        return self.run(lambda client, remaining: client.disable_pwm(gpio_pin, remaining), hosts, deadline)
+    
+    def get_status(self, gpio_pin=None, hosts=None, deadline=None):
+        """Статус на пина от всеки daemon"""
+        return self.run(lambda client, remaining: client.get_status(gpio_pin, remaining), hosts, deadline)
+
+
+def load_options(options_path=OPTIONS_PATH):
     """Load addon options from Home Assistant"""
-    options_path = "/data/options.json"
     default_options = {
         "gpio_pin": 12,
         "duty_cycle": 50,
         "frequency": 26000,
         "auto_start": True,
+        "channels": [],
         "daemon_host": "127.0.0.1",
-        "daemon_port": 9000
+        "daemon_port": 9000,
+        "daemons": [],
+        "log_level": "info"
     }
     
     if os.path.exists(options_path):
@@ -168,8 +1243,265 @@ def load_options():
     return default_options
 
 
+def channel_configs(options):
+    """Списък с канали от "channels"; без него - единичният gpio_pin от старите опции"""
+    defaults = {
+        "frequency": options.get("frequency", 26000),
+        "duty_cycle": options.get("duty_cycle", 50),
+        "auto_start": options.get("auto_start", True),
+    }
+    channels = options.get("channels") or [{"gpio_pin": options.get("gpio_pin", 12)}]
+    return [{**defaults, **channel} for channel in channels]
+
+
+def fleet_daemons(options):
+    """Списък с daemon-и от "daemons"; без него - единичният daemon_host/daemon_port
+    
+    Добавката говори с daemon-ите само по HTTP: контейнерът ѝ няма достъп до
+    Unix socket-а на хоста (бинарният протокол е за локални клиенти на PWMClient).
+    """
+    daemons = options.get("daemons")
+    if not daemons:
+        return [{"host": options.get("daemon_host", "127.0.0.1"),
+                 "port": options.get("daemon_port", 9000),
+                 "transport": "http"}]
+    return [{"port": 9000, **daemon, "transport": "http"} for daemon in daemons]
+
+
+class OptionsWatcher:
+    """Извиква on_change() при запис на options.json (inotify)
+    
+    Следи се директорията, защото Supervisor може да замени файла с rename.
+    Нишката блокира в read() и не се събужда, докато файлът не се промени.
+    Без inotify (не-Linux) start() връща False и остава само SIGHUP.
+    """
+    
+    def __init__(self, on_change, options_path=OPTIONS_PATH):
+        self.on_change = on_change
+        self.directory, name = os.path.split(options_path)
+        self.name = name.encode()
+        self.fd = None
+    
+    def start(self):
+        """Започни следенето; False, ако inotify не е наличен"""
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            if libc.inotify_add_watch(fd, os.fsencode(self.directory or "."),
+                                      INOTIFY_CLOSE_WRITE | INOTIFY_MOVED_TO) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, os.strerror(errno))
+        except (OSError, AttributeError) as e:
+            logger.warning(f"Cannot watch {self.directory} for option changes ({e}); send SIGHUP to reload")
+            return False
+        
+        self.fd = fd
+        threading.Thread(target=self._run, name="pwm-options-watch", daemon=True).start()
+        return True
+    
+    def _run(self):
+        """Чети събитията и извиквай on_change() за options.json"""
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as e:
+                logger.warning(f"Option watch stopped: {e}")
+                return
+            offset, changed = 0, False
+            while offset + INOTIFY_EVENT.size <= len(data):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                changed |= data[offset:offset + length].rstrip(b"\0") == self.name
+                offset += length
+            if changed:
+                self.on_change()
+
+
+def log_configuration(options):
+    """Покажи конфигурацията"""
+    logger.info(f"Configuration:")
+    for channel in channel_configs(options):
+        logger.info(f"  - GPIO{channel['gpio_pin']}: {channel['duty_cycle']}%, "
+                    f"{channel['frequency']} Hz ({channel['frequency']/1000} kHz), "
+                    f"auto start: {channel['auto_start']}")
+    for daemon in fleet_daemons(options):
+        logger.info(f"  - Daemon: {daemon['host']}:{daemon['port']} ({daemon['transport']})")
+
+
+class PWMAddon:
+    """Приложената конфигурация на addon-а и клиентите към daemon-ите
+    
+    channels пази това, което всеки daemon реално е приел, по пин. При нови
+    опции apply_channels() изпраща желаното състояние на всеки променен канал
+    с един PUT /pins/{gpio} (PWMClient.apply), а daemon записва само
+    разликата: нова яркост е един запис на duty_cycle, нова честота - период
+    и duty, без освобождаване на канала. Всички daemon-и от "daemons"
+    получават еднаквите канали паралелно.
+    """
+    
+    def __init__(self, options):
+        self.options = options
+        self.fleet = None
+        self.channels = {}  # {daemon: {gpio_pin: приложена конфигурация}}
+        self.watch_stop = {}  # {daemon: threading.Event}
+    
+    def connect(self):
+        """Създай клиенти според опциите за връзка; False ако нито един daemon не отговаря"""
+        options = self.options
+        fleet = PWMFleet(fleet_daemons(options), workers=max(4, len(channel_configs(options))))
+        connected = fleet.check_connection()["hosts"]
+        if not any(entry["ok"] for entry in connected.values()):
+            fleet.close()
+            return False
+        for name, entry in connected.items():
+            if not entry["ok"]:
+                logger.error(f"✗ {name} is not responding; its channels are applied again on the next options change")
+        self.fleet = fleet
+        return True
+    
+    @staticmethod
+    def _apply_channel(pwm, gpio_pin, current, target):
+        """Доведи един канал от current до target; връща приложената конфигурация (или None)"""
+        if target is None:
+            pwm.disable_pwm(gpio_pin)
+            return None if pwm.unexport_pwm(gpio_pin) else current
+        
+        if current == target:
+            return current
+        state = {"frequency": target["frequency"], "duty_cycle": target["duty_cycle"],
+                 "enabled": target["auto_start"]}
+        return dict(target) if pwm.apply(state, gpio_pin) is not None else current
+    
+    def apply_channels(self, channels):
+        """Приложи списъка с канали на всички daemon-и (паралелно по daemon и по пин)
+        
+        Връща True ако всички канали са приложени навсякъде.
+        """
+        desired = {channel["gpio_pin"]: channel for channel in channels}
+        
+        def apply(current):
+            def run(client, remaining):
+                results = client.map_pins(
+                    lambda pin: self._apply_channel(client, pin, current.get(pin), desired.get(pin)),
+                    set(desired) | set(current))
+                return {pin: applied for pin, applied in results.items() if applied is not None}
+            return run
+        
+        result = self.fleet.run({name: apply(self.channels.get(name, {})) for name in self.fleet.clients},
+                                deadline=APPLY_DEADLINE, ok=lambda applied: applied == desired)
+        changed = []
+        for name, entry in result["hosts"].items():
+            if entry["error"]:
+                logger.error(f"{name}: {entry['error']}")
+                continue
+            if set(entry["result"]) != set(self.channels.get(name, {})):
+                changed.append(name)
+            self.channels[name] = entry["result"]
+        
+        if changed:
+            self._restart_watch(changed)
+        return result["ok"]
+    
+    def missing_channels(self, channels):
+        """Каналите от списъка, които не са приложени, напр. ["GPIO12"] или ["pi2:9000 GPIO12"]"""
+        prefix = len(self.fleet.clients) > 1
+        return [f"{name} GPIO{channel['gpio_pin']}" if prefix else f"GPIO{channel['gpio_pin']}"
+                for name in self.fleet.clients for channel in channels
+                if channel["gpio_pin"] not in self.channels.get(name, {})]
+    
+    def reload(self):
+        """Прочети options.json отново и приложи разликата"""
+        try:
+            with open(OPTIONS_PATH, 'r') as f:
+                options = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading options: {e}; keeping current configuration")
+            return
+        if options == self.options:
+            return
+        
+        started = time.monotonic()
+        logger.info(f"Options changed: {options}")
+        logging.getLogger().setLevel(options.get("log_level", "info").upper())
+        
+        if any(options.get(key) != self.options.get(key) for key in CONNECTION_OPTIONS):
+            old_options, old_fleet, old_channels = self.options, self.fleet, self.channels
+            self.options = options
+            if not self.connect():
+                logger.error("Cannot connect to the new pwm-daemon; keeping the current connection")
+                self.options = old_options
+                return
+            self._stop_watch()
+            self._disable_all(old_fleet, old_channels)
+            old_fleet.close()
+            self.channels = {}
+        self.options = options
+        
+        if not self.apply_channels(channel_configs(options)):
+            logger.error("Some channels could not be updated")
+        logger.info(f"✓ Options applied in {(time.monotonic() - started) * 1000:.1f} ms")
+    
+    @staticmethod
+    def _disable_all(fleet, channels):
+        """Изключи приложените канали на всички daemon-и паралелно"""
+        fleet.run({name: (lambda client, remaining, pins=channels.get(name, {}):
+                          client.map_pins(client.disable_pwm, pins))
+                   for name in fleet.clients}, deadline=APPLY_DEADLINE)
+    
+    def _restart_watch(self, names):
+        """Следи статуса на текущите канали на тези daemon-и (нова SSE връзка при промяна на пиновете)"""
+        for name in names:
+            stop = self.watch_stop.pop(name, None)
+            if stop:
+                stop.set()
+            pins = sorted(self.channels.get(name, {}))
+            if not pins:
+                continue
+            self.watch_stop[name] = threading.Event()
+            label = f"{name} " if len(self.fleet.clients) > 1 else ""
+            threading.Thread(target=self._watch_status,
+                             args=(self.fleet.clients[name], pins, self.watch_stop[name], label),
+                             name="pwm-watch", daemon=True).start()
+    
+    @staticmethod
+    def _watch_status(pwm, pins, stop, label=""):
+        """Log status changes pushed by the daemon instead of polling"""
+        for event, event_id, data in pwm.watch(pins=pins, stop=stop):
+            if event == "snapshot":
+                for pin in pins:
+                    status = data.get(str(pin))
+                    if status:
+                        logger.info(f"{label}Status GPIO{pin}: {status}")
+                    else:
+                        logger.warning(f"{label}GPIO{pin} is not initialized on pwm-daemon")
+                continue
+            
+            changes = {k: v for k, v in data.items() if k != "gpio_pin"}
+            if set(changes) == {"duty_cycle"}:
+                logger.debug(f"{label}Status change GPIO{data.get('gpio_pin')}: {changes}")
+            else:
+                logger.info(f"{label}Status change GPIO{data.get('gpio_pin')}: {changes}")
+    
+    def _stop_watch(self):
+        """Спри следенето на всички daemon-и"""
+        for stop in self.watch_stop.values():
+            stop.set()
+        self.watch_stop = {}
+    
+    def shutdown(self):
+        """Изключи каналите и затвори връзките"""
+        self._stop_watch()
+        if self.fleet:
+            self._disable_all(self.fleet, self.channels)
+            self.fleet.close()
+
+
 def main():
     """Main entry point"""
+    log_listener = start_async_logging()
     logger.info("=" * 60)
     logger.info("PWM LED Controller for Home Assistant OS")
     logger.info("HTTP API Client for pwm-daemon")
@@ -177,73 +1509,66 @@ def main():
     
     # Load configuration
     options = load_options()
-    gpio_pin = options.get("gpio_pin", 12)
-    duty_cycle = options.get("duty_cycle", 50)
-    frequency = options.get("frequency", 26000)
-    auto_start = options.get("auto_start", True)
-    daemon_host = options.get("daemon_host", "127.0.0.1")
-    daemon_port = options.get("daemon_port", 9000)
+    logging.getLogger().setLevel(options.get("log_level", "info").upper())
+    log_configuration(options)
     
-    logger.info(f"Configuration:")
-    logger.info(f"  - GPIO Pin: {gpio_pin}")
-    logger.info(f"  - Duty Cycle: {duty_cycle}%")
-    logger.info(f"  - Frequency: {frequency} Hz ({frequency/1000} kHz)")
-    logger.info(f"  - Auto Start: {auto_start}")
-    logger.info(f"  - Daemon: {daemon_host}:{daemon_port}")
-    
-    # Create PWM client
-    pwm = PWMClient(host=daemon_host, port=daemon_port)
-    
-    # Check connection
-    if not pwm.check_connection():
+    # Create PWM clients (one per daemon, one worker per channel so startup/shutdown run in parallel)
+    addon = PWMAddon(options)
+    if not addon.connect():
         logger.error("Cannot connect to pwm-daemon!")
         logger.error("Make sure pwm-daemon is installed and running on host:")
         logger.error("  sudo systemctl status pwm-daemon")
+        log_listener.stop()
         sys.exit(1)
     
-    # Initialize PWM
-    if not pwm.initialize_pwm(gpio_pin, frequency):
-        logger.error("Failed to initialize PWM!")
-        sys.exit(1)
+    # Initialize PWM, set duty cycle and enable if auto_start (one request per channel, in parallel)
+    if not addon.apply_channels(channel_configs(options)):
+        if not any(addon.channels.values()):
+            logger.error("Failed to initialize PWM!")
+            addon.shutdown()
+            log_listener.stop()
+            sys.exit(1)
+        logger.error(f"Failed to initialize PWM on {', '.join(addon.missing_channels(channel_configs(options)))}")
     
-    # Set duty cycle
-    pwm.set_duty_cycle(duty_cycle)
+    started = {pin for applied in addon.channels.values() for pin, channel in applied.items() if channel["auto_start"]}
+    if started:
+        logger.info(f"✓ PWM started automatically on {', '.join(f'GPIO{pin}' for pin in sorted(started))}")
     
-    # Enable if auto_start
-    if auto_start:
-        pwm.enable_pwm()
-        logger.info(f"✓ PWM started automatically")
+    # SIGINT/SIGTERM stop the addon; SIGHUP and writes to options.json reload the options
+    stop = threading.Event()
+    reload_requested = threading.Event()
+    wakeup = threading.Event()
     
-    # Handle graceful shutdown
     def signal_handler(sig, frame):
         logger.info("Shutting down...")
-        pwm.disable_pwm()
-        sys.exit(0)
+        stop.set()
+        wakeup.set()
+    
+    def request_reload(*_):
+        reload_requested.set()
+        wakeup.set()
     
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGHUP, request_reload)
+    OptionsWatcher(request_reload).start()
     
-    # Keep running and log status periodically
     logger.info("PWM Controller running. Press Ctrl+C to stop.")
     logger.info("-" * 60)
     
     try:
-        last_log_time = 0
-        while True:
-            time.sleep(1)
+        while not stop.is_set():
+            wakeup.wait()
+            wakeup.clear()
+            if stop.is_set():
+                break
             
-            # Log status every 60 seconds
-            current_time = int(time.time())
-            if current_time - last_log_time >= 60:
-                status = pwm.get_status()
-                if status:
-                    logger.info(f"Status: {status}")
-                last_log_time = current_time
-                
-    except KeyboardInterrupt:
-        logger.info("Interrupted by user")
+            if reload_requested.is_set():
+                reload_requested.clear()
+                addon.reload()
     finally:
-        pwm.disable_pwm()
+        addon.shutdown()
+        log_listener.stop()
 
 
 if __name__ == "__main__":